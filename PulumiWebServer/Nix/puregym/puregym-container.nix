@@ -31,6 +31,19 @@ in {
       description = lib.mdDoc "PureGym port inside container";
       default = 1735;
     };
+    watchedGyms = lib.mkOption {
+      type = lib.types.listOf lib.types.ints.unsigned;
+      description = lib.mdDoc "Gym IDs scraped by Prometheus; their fullness is refreshed in the background";
+      default = [19];
+    };
+    workerArgs = lib.mkOption {
+      type = lib.types.nullOr (lib.types.listOf lib.types.str);
+      description = lib.mdDoc ''
+        Arguments that start PureGym.App as a long-lived worker speaking newline-delimited JSON on stdin/stdout,
+        so queries don't each start the .NET runtime. If null, every query runs its own PureGym.App process.
+      '';
+      default = null;
+    };
   };
 
   config = lib.mkIf cfg.enable {
@@ -149,11 +162,16 @@ in {
             User = "puregym";
             Group = "puregym";
             ExecStart = "${pkgs.python3}/bin/python ${./puregym.py}";
+            StateDirectory = "puregym";
           };
           environment = {
             PUREGYM_CLIENT = "${puregym-client}/bin/PureGym.App";
             PUREGYM_PORT = toString cfg.port;
             PUREGYM_TOKEN_PATH = tokenPath;
+            PUREGYM_GYM_SNAPSHOT = "/var/lib/puregym/gyms.json";
+            PUREGYM_HISTORY_PATH = "/var/lib/puregym/history.json";
+            PUREGYM_WATCHED_GYMS = lib.concatMapStringsSep "," toString cfg.watchedGyms;
+            PUREGYM_WORKER_ARGS = lib.mkIf (cfg.workerArgs != null) (lib.escapeShellArgs cfg.workerArgs);
           };
         };
 
@@ -162,12 +180,28 @@ in {
       };
     };
 
-    # nginx on the host proxies to the container
+    # nginx on the host proxies to the container, and caches whatever the server marks cacheable
+    # (fullness for its remaining TTL, the gym mapping until its daily refresh).
+    services.nginx.proxyCachePath.puregym = {
+      enable = true;
+      keysZoneName = "puregym";
+      keysZoneSize = "1m";
+      maxSize = "16m";
+      inactive = "1d";
+    };
     services.nginx.virtualHosts."${cfg.subdomain}.${cfg.domain}" = {
       forceSSL = true;
       enableACME = true;
       locations."/" = {
         proxyPass = "http://${containerAddress}:${toString cfg.port}/";
+        extraConfig = ''
+          proxy_cache puregym;
+          # Expired entries are revalidated with a conditional GET, one request at a time.
+          proxy_cache_revalidate on;
+          proxy_cache_lock on;
+          proxy_cache_use_stale error timeout updating;
+          add_header X-Cache-Status $upstream_cache_status;
+        '';
       };
     };
 
@@ -188,7 +222,7 @@ in {
             targets = ["${containerAddress}:${toString cfg.port}"];
           }
         ];
-        params = {gym_id = ["19"];};
+        params = {gym_id = map toString cfg.watchedGyms;};
         metrics_path = "/fullness-prometheus";
         scrape_interval = "5m";
       }
@@ -1,20 +1,631 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import subprocess
 import os
-from datetime import datetime, timedelta
-from typing import AnyStr, Callable
+import json
+import bisect
+import calendar
+import contextlib
+import email.utils
+import gzip
+import hashlib
+import queue
+import random
+import select
+import shlex
+import sys
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Any, AnyStr, Callable, Hashable, Iterator, Optional
 from urllib.parse import urlparse, parse_qs
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GymDirectory:
+    """
+    The gym ID -> name mapping, shared by every request. It is refetched at most once per `ttl`
+    and swapped in whole, and optionally snapshotted to disk so a restarted server needn't ask the API.
+    """
+
+    def __init__(self, snapshot_path: Optional[str], ttl: timedelta = timedelta(days=1)):
+        self._snapshot_path = snapshot_path
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._gyms: dict[int, str] = {}
+        self._names: dict[str, str] = {}
+        self._refreshed = datetime.min
+        self._load_snapshot()
+
+    def _load_snapshot(self) -> None:
+        if self._snapshot_path is None:
+            return
+        try:
+            with open(self._snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._set_gyms({int(gym_id): gym_name for gym_id, gym_name in snapshot['gyms'].items()})
+            self._refreshed = datetime.fromisoformat(snapshot['refreshed'])
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Not using gym snapshot {self._snapshot_path}: {e}', file=sys.stderr)
+
+    def _save_snapshot(self) -> None:
+        if self._snapshot_path is None:
+            return
+        temp_path = f'{self._snapshot_path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'refreshed': self._refreshed.isoformat(), 'gyms': self._gyms}, f)
+            os.replace(temp_path, self._snapshot_path)
+        except OSError as e:
+            print(f'Failed to write gym snapshot {self._snapshot_path}: {e}', file=sys.stderr)
+
+    def _set_gyms(self, gyms: dict[int, str]) -> None:
+        self._names = {normalise_gym_name(gym_name): gym_name for gym_name in gyms.values()}
+        self._gyms = gyms
+
+    @staticmethod
+    def _fetch() -> dict[int, str]:
+        output = run_client('all-gyms', '--terse', 'true').stdout
+        gyms = {}
+        for line in output.splitlines():
+            gym_id, gym_name = line.split(',')
+            gyms[int(gym_id)] = gym_name
+        return gyms
+
+    def gyms(self) -> dict[int, str]:
+        if self._refreshed < datetime.now() - self._ttl:
+            with self._lock:
+                if self._refreshed < datetime.now() - self._ttl:
+                    try:
+                        new_gyms = self._fetch()
+                    except subprocess.CalledProcessError as e:
+                        if not self._gyms:
+                            raise
+                        # Keep serving the old mapping, and try again in a few minutes.
+                        print(f'Failed to refresh gyms, keeping stale mapping: {describe_failure(e)}', file=sys.stderr)
+                        self._refreshed = datetime.now() - self._ttl + timedelta(minutes=5)
+                    else:
+                        self._set_gyms(new_gyms)
+                        self._refreshed = datetime.now()
+                        self._save_snapshot()
+        return self._gyms
+
+    @property
+    def refreshed(self) -> datetime:
+        return self._refreshed
+
+    @property
+    def ttl(self) -> timedelta:
+        return self._ttl
+
+    def canonical_name(self, gym_name: str) -> Optional[str]:
+        """The directory's spelling of `gym_name`, ignoring case and spacing, or None if it isn't a known gym."""
+        self.gyms()
+        return self._names.get(normalise_gym_name(gym_name))
+
+
+def normalise_gym_name(gym_name: str) -> str:
+    return ' '.join(gym_name.split()).casefold()
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header admits gzip: named, or covered by *, with a nonzero q-value."""
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share a single execution, and all get its result (or exception)."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[Hashable, SingleFlight._Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._calls
+
+
+class ResultCache:
+    """
+    A bounded cache of upstream results, shared by the request threads. Successes are fresh for `ttl` and
+    failures for `negative_ttl`, and once there are `max_entries` the least recently used entry is evicted.
+    """
+
+    class _Entry:
+        def __init__(self, value: Optional[bytes], error: Optional[Exception]):
+            self.value = value
+            self.error = error
+            self.stored = datetime.now()
+
+        def age(self) -> timedelta:
+            # abs(), so that the clock being set back doesn't make an entry fresh forever.
+            return abs(datetime.now() - self.stored)
+
+    def __init__(self, max_entries: int, ttl: timedelta, negative_ttl: timedelta):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, ResultCache._Entry] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, max_age: Optional[timedelta] = None, count: bool = True) -> Optional[bytes]:
+        """
+        The cached value for `key` if it is younger than `max_age` (by default, the TTL), and None otherwise.
+        A cached failure is raised again. Re-checks that mustn't skew the hit ratio pass `count=False`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.error is not None:
+                    max_age = self._negative_ttl
+                if entry.age() <= (max_age or self._ttl):
+                    self._entries.move_to_end(key)
+                    self.hits += count
+                    if entry.error is not None:
+                        raise entry.error.with_traceback(None)
+                    return entry.value
+            self.misses += count
+            return None
+
+    def age(self, key: Hashable) -> Optional[timedelta]:
+        """How old the cached success for `key` is, if there is one."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None or entry.error is not None else entry.age()
+
+    def _store(self, key: Hashable, entry: 'ResultCache._Entry') -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        with self._lock:
+            self._store(key, ResultCache._Entry(value, None))
+
+    def put_failure(self, key: Hashable, error: Exception) -> None:
+        with self._lock:
+            existing = self._entries.get(key)
+            # A failed refresh doesn't replace an earlier success, which may still be served while stale.
+            if existing is None or existing.error is not None:
+                self._store(key, ResultCache._Entry(None, error))
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self._max_entries, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    """A Prometheus counter with one series per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...]):
+        self.name = name
+        self._documentation = documentation
+        self._label_names = label_names
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, labels: tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] += amount
+
+    def exposition(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self._documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{format_labels(self._label_names, labels)} {value:g}')
+        return lines
+
+
+class Histogram:
+    """A Prometheus histogram with one series per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self._documentation = documentation
+        self._label_names = label_names
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        # Per label values: a count per bucket (not cumulative), then the sum and count of observations.
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, labels: tuple[str, ...], value: float) -> None:
+        with self._lock:
+            series = self._series.setdefault(labels, [[0] * len(self._buckets), 0.0, 0])
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def exposition(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self._documentation}', f'# TYPE {self.name} histogram']
+        label_names = (*self._label_names, 'le')
+        with self._lock:
+            for labels, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self._buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{format_labels(label_names, (*labels, f"{bound:g}"))} {cumulative}')
+                lines.append(f'{self.name}_bucket{format_labels(label_names, (*labels, "+Inf"))} {count}')
+                lines.append(f'{self.name}_sum{format_labels(self._label_names, labels)} {total:g}')
+                lines.append(f'{self.name}_count{format_labels(self._label_names, labels)} {count}')
+        return lines
+
+
+# `mode` is "process" when each query starts the .NET client and "worker" when a long-lived one answers it,
+# so comparing the two separates runtime start-up from time spent on the PureGym API.
+metric_client_seconds = Histogram(
+    'puregym_client_seconds', 'Wall-clock time of PureGym client queries.', ('command', 'mode'),
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+metric_client_failures = Counter(
+    'puregym_client_failures_total', 'PureGym client queries that failed, by how they failed.',
+    ('command', 'reason'))
+
+
+class FullnessHistory:
+    """
+    The last `capacity` fullness readings of each gym, in ring buffers of packed arrays (10 bytes a reading),
+    so that "when is it quiet" needs neither Prometheus nor the API. Optionally persisted to `path`.
+    """
+
+    class _Ring:
+        def __init__(self, capacity: int):
+            self.times = array('d', bytes(8 * capacity))
+            self.values = array('H', bytes(2 * capacity))
+            self.start = 0
+            self.size = 0
+
+        def append(self, timestamp: float, value: int) -> None:
+            end = (self.start + self.size) % len(self.times)
+            self.times[end] = timestamp
+            self.values[end] = value
+            if self.size < len(self.times):
+                self.size += 1
+            else:
+                self.start = (self.start + 1) % len(self.times)
+
+        def readings(self) -> tuple[array, array]:
+            """Timestamps and values, oldest first."""
+            end = self.start + self.size
+            if end <= len(self.times):
+                return self.times[self.start:end], self.values[self.start:end]
+            end %= len(self.times)
+            return (self.times[self.start:] + self.times[:end],
+                    self.values[self.start:] + self.values[:end])
+
+    def __init__(self, capacity: int, path: Optional[str]):
+        self._capacity = capacity
+        self._path = path
+        self._lock = threading.Lock()
+        self._rings: dict[int, FullnessHistory._Ring] = {}
+        self._load()
+
+    def _load(self) -> None:
+        if self._path is None:
+            return
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                saved = json.load(f)
+            for gym_id, readings in saved.items():
+                for timestamp, value in zip(readings['times'], readings['values']):
+                    self.record(int(gym_id), timestamp, value)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f'Not using fullness history {self._path}: {e}', file=sys.stderr)
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        with self._lock:
+            saved = {}
+            for gym_id, ring in self._rings.items():
+                times, values = ring.readings()
+                saved[gym_id] = {'times': times.tolist(), 'values': values.tolist()}
+        temp_path = f'{self._path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(saved, f)
+            os.replace(temp_path, self._path)
+        except OSError as e:
+            print(f'Failed to write fullness history {self._path}: {e}', file=sys.stderr)
+
+    def save_forever(self, interval_seconds: float) -> None:
+        while True:
+            time.sleep(interval_seconds)
+            self.save()
+
+    def record(self, gym_id: int, timestamp: float, value: int) -> None:
+        with self._lock:
+            ring = self._rings.get(gym_id)
+            if ring is None:
+                ring = self._rings[gym_id] = FullnessHistory._Ring(self._capacity)
+            if ring.size and ring.times[(ring.start + ring.size - 1) % self._capacity] >= timestamp:
+                return
+            ring.append(timestamp, max(0, min(value, 0xFFFF)))
+
+    def since(self, gym_id: int, since: float) -> Optional[tuple[array, array]]:
+        """The gym's readings from `since` onwards, oldest first, or None if it isn't being recorded."""
+        with self._lock:
+            ring = self._rings.get(gym_id)
+            if ring is None:
+                return None
+            times, values = ring.readings()
+        first = bisect.bisect_left(times, since)
+        return times[first:], values[first:]
+
+
+def summarise_fullness(times: array, values: array) -> dict[str, Any]:
+    """Hourly averages of the readings, and each weekday's average by hour of day (server local time)."""
+    hourly: dict[float, list[int]] = {}
+    for timestamp, value in zip(times, values):
+        total = hourly.setdefault(timestamp - timestamp % 3600, [0, 0])
+        total[0] += value
+        total[1] += 1
+
+    by_weekday = [[[0, 0] for _hour in range(24)] for _day in range(7)]
+    for hour_start, (total, count) in hourly.items():
+        local = time.localtime(hour_start)
+        weekday_total = by_weekday[local.tm_wday][local.tm_hour]
+        weekday_total[0] += total
+        weekday_total[1] += count
+
+    weekdays = {}
+    for day, hours in enumerate(by_weekday):
+        means = [round(total / count, 1) if count else None for total, count in hours]
+        known = [hour for hour, mean in enumerate(means) if mean is not None]
+        weekdays[calendar.day_name[day]] = {
+            'hourly_mean': means,
+            'busiest_hours': sorted(known, key=lambda hour: means[hour], reverse=True)[:3],
+            'quietest_hours': sorted(known, key=lambda hour: means[hour])[:3],
+        }
+    return {
+        'hourly': [[hour_start, round(total / count, 1)] for hour_start, (total, count) in hourly.items()],
+        'by_weekday': weekdays,
+    }
+
+
+class TokenFile:
+    """The bearer token, read in-process and re-read only when the file's mtime changes."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._mtime_ns: Optional[int] = None
+        self._token = ''
+
+    def get(self) -> str:
+        mtime_ns = os.stat(self._path).st_mtime_ns
+        with self._lock:
+            if mtime_ns != self._mtime_ns:
+                with open(self._path, encoding='utf-8') as f:
+                    self._token = f.read().strip()
+                self._mtime_ns = mtime_ns
+            return self._token
+
+
+class ClientWorker:
+    """
+    One long-lived PureGym client process, so that queries don't each pay for the .NET runtime to start.
+    It speaks newline-delimited JSON on stdin/stdout: each request is {"args": [...]}, the arguments a
+    one-shot invocation would take, and each reply is {"exit_code": int, "stdout": str, "stderr": str}.
+    A worker that dies, talks nonsense or doesn't reply within `timeout` seconds is killed, and the request
+    retried once on a fresh one.
+    """
+
+    def __init__(self, command: list[str], timeout: float):
+        self._command = command
+        self._timeout = timeout
+        self._process: Optional[subprocess.Popen] = None
+        # Bytes read from the worker's stdout beyond the last complete reply.
+        self._pending = b''
+
+    def _start(self) -> subprocess.Popen:
+        if self._process is None or self._process.poll() is not None:
+            self._process = subprocess.Popen(self._command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._pending = b''
+        return self._process
+
+    def _kill(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def _read_line(self, process: subprocess.Popen) -> bytes:
+        """The worker's next line of output, read unbuffered so that the wait for it can time out."""
+        deadline = time.monotonic() + self._timeout
+        fd = process.stdout.fileno()
+        while b'\n' not in self._pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError(f'no reply within {self._timeout:g}s')
+            data = os.read(fd, 65536)
+            if not data:
+                raise EOFError('worker exited')
+            self._pending += data
+        line, self._pending = self._pending.split(b'\n', 1)
+        return line
+
+    def run(self, args: list[str]) -> subprocess.CompletedProcess:
+        for attempt in range(2):
+            process = self._start()
+            try:
+                process.stdin.write(json.dumps({'args': args}).encode('utf-8') + b'\n')
+                process.stdin.flush()
+                reply = json.loads(self._read_line(process))
+                return subprocess.CompletedProcess(
+                    [*self._command, *args], reply['exit_code'], reply['stdout'], reply['stderr'])
+            except (OSError, EOFError, ValueError, KeyError) as e:
+                self._kill()
+                if attempt == 1:
+                    raise OSError(f'PureGym worker failed twice: {e}') from e
+                print(f'PureGym worker failed, restarting: {e}', file=sys.stderr)
+
+
+class ClientWorkerPool:
+    """A fixed set of `ClientWorker`s, each serving one request at a time."""
+
+    def __init__(self, command: list[str], size: int, timeout: float):
+        self._idle: queue.SimpleQueue[ClientWorker] = queue.SimpleQueue()
+        for _ in range(size):
+            self._idle.put(ClientWorker(command, timeout))
+
+    @contextlib.contextmanager
+    def worker(self) -> Iterator[ClientWorker]:
+        """An idle worker, waited for if all are busy, and returned to the pool afterwards."""
+        worker = self._idle.get()
+        try:
+            yield worker
+        finally:
+            self._idle.put(worker)
+
+
+def run_client(*args: str) -> subprocess.CompletedProcess:
+    """
+    Run a PureGym client query with the bearer token supplied, on a long-lived worker if one is configured
+    and as a one-shot process otherwise. Raises CalledProcessError if the query fails, and OSError if the
+    client can't be run at all.
+    """
+    command = args[0]
+    args = [command, '--bearer-token', bearer_token.get(), *args[1:]]
+    try:
+        if client_workers is None:
+            start = time.monotonic()
+            try:
+                return subprocess.run(
+                    [puregym, *args], text=True, encoding='utf-8', stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, check=True)
+            finally:
+                metric_client_seconds.observe((command, 'process'), time.monotonic() - start)
+        # Time only the query itself, not the wait for a worker to come free.
+        with client_workers.worker() as worker:
+            start = time.monotonic()
+            try:
+                completed_process = worker.run(args)
+            finally:
+                metric_client_seconds.observe((command, 'worker'), time.monotonic() - start)
+        completed_process.check_returncode()
+        return completed_process
+    except subprocess.CalledProcessError:
+        metric_client_failures.inc((command, 'exit_status'))
+        raise
+    except OSError:
+        metric_client_failures.inc((command, 'not_run'))
+        raise
+
+
+def describe_failure(e: BaseException) -> str:
+    """
+    A query failure, fit for logs and responses. Not str(e) for a CalledProcessError: the command line it
+    quotes includes the bearer token.
+    """
+    if isinstance(e, subprocess.CalledProcessError):
+        stderr = (e.stderr or '').strip()
+        return f'exit status {e.returncode}' + (f': {stderr}' if stderr else '')
+    return str(e)
 
 
 class MyHandler(BaseHTTPRequestHandler):
-    _cache_result_by_id = {}
-    _cache_result_by_name = {}
-    _last_accessed_by_id = defaultdict(lambda: datetime.min)
-    _last_accessed_by_name = defaultdict(lambda: datetime.min)
+    # Cache misses for the same gym wait on one upstream call rather than each making their own.
+    _fills = SingleFlight()
+
+    # The rendered /gym-mapping, plain and gzipped, and the mapping it was rendered from.
+    _mapping_body: tuple[dict[int, str], bytes, bytes] = ({}, b'', b'')
+
+    def _send_cacheable(self, body: bytes, content_type: str, last_modified: datetime, max_age: timedelta,
+                        gzipped: Optional[bytes] = None) -> None:
+        """
+        Send `body` with validators and a freshness lifetime so that nginx and clients can cache it, answering
+        a matching conditional GET with 304. If `gzipped` is given, it's sent to clients that accept gzip.
+        """
+        etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        send_gzipped = gzipped is not None and accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        if send_gzipped:
+            body = gzipped
+            # A different representation, so it needs its own entity tag.
+            etag = f'{etag[:-1]}-gzip"'
+        last_modified = last_modified.replace(microsecond=0)
 
-    _all_gyms = {}
-    _last_refreshed_gyms = datetime.min
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            not_modified = etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*'
+        else:
+            try:
+                if_modified_since = email.utils.parsedate_to_datetime(self.headers.get('If-Modified-Since', ''))
+                not_modified = last_modified.astimezone(timezone.utc) <= if_modified_since
+            except (TypeError, ValueError):
+                not_modified = False
+
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.format_datetime(last_modified.astimezone(timezone.utc), usegmt=True))
+        self.send_header('Cache-Control', f'public, max-age={max(0, int(max_age.total_seconds()))}')
+        if gzipped is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if send_gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        if not_modified:
+            self.end_headers()
+            return
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def _bad_request(self, text: str, code: int = 400) -> None:
         self.send_response(code)
@@ -22,39 +633,142 @@ class MyHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(text.encode('utf-8'))
 
+    @classmethod
+    def _fill_fullness(cls, gym_id: int) -> bytes:
+        def fill() -> bytes:
+            output = fullness_by_id.get(gym_id, count=False)
+            if output is not None:
+                return output
+            try:
+                output = run_client('fullness', '--gym-id', str(gym_id)).stdout.encode('utf-8')
+            except subprocess.CalledProcessError as e:
+                fullness_by_id.put_failure(gym_id, e)
+                raise
+            fullness_by_id.put(gym_id, output)
+            if gym_id in watched_gyms:
+                try:
+                    fullness_history.record(gym_id, time.time(), int(output.split(b' ')[0]))
+                except ValueError:
+                    pass
+            return output
+
+        return cls._fills.do(('id', gym_id), fill)
+
+    @classmethod
+    def _fill_fullness_in_background(cls, gym_id: int) -> None:
+        if cls._fills.in_flight(('id', gym_id)):
+            return
+
+        def fill():
+            try:
+                cls._fill_fullness(gym_id)
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f'Background refresh of gym {gym_id} failed: {describe_failure(e)}', file=sys.stderr)
+
+        threading.Thread(target=fill, daemon=True).start()
+
     def _get_fullness(self, gym_id: int) -> bytes:
-        if abs(datetime.now() - self._last_accessed_by_id[gym_id]) > timedelta(seconds=30):
-            token = subprocess.check_output(['cat', token_path]).strip()
-            output = subprocess.check_output(
-                [puregym, 'fullness', '--bearer-token', token, '--gym-id', str(gym_id)], text=True,
-                encoding='utf-8')
-            output = output.encode('utf-8')
-            self._cache_result_by_id[gym_id] = output
-            self._last_accessed_by_id[gym_id] = datetime.now()
+        if gym_id in watched_gyms:
+            # Stale-while-revalidate: the prefetcher normally keeps these fresh, so a stale entry
+            # just means we caught it mid-refresh. Serve it, unless it's older than we'll tolerate.
+            output = fullness_by_id.get(gym_id, max_staleness)
+            if output is not None:
+                if fullness_by_id.age(gym_id) > result_ttl:
+                    self._fill_fullness_in_background(gym_id)
+                return output
         else:
-            output = self._cache_result_by_id[gym_id]
+            output = fullness_by_id.get(gym_id)
+            if output is not None:
+                return output
+        return self._fill_fullness(gym_id)
+
+    @staticmethod
+    def _resolve_gym_name(gym_name: str) -> tuple[str, str]:
+        """The name to ask the client for, and the cache key: spellings of the same gym share an entry."""
+        try:
+            canonical_name = gym_directory.canonical_name(gym_name)
+        except (subprocess.CalledProcessError, OSError) as e:
+            # No directory to check against; the client can still judge the name itself.
+            print(f'Cannot resolve gym name {gym_name!r}: {describe_failure(e)}', file=sys.stderr)
+            canonical_name = None
+        if canonical_name is not None:
+            gym_name = canonical_name
+        return gym_name, normalise_gym_name(gym_name)
+
+    def _get_fullness_by_name(self, gym_name: str, key: str) -> bytes:
+        def fill() -> bytes:
+            output = fullness_by_name.get(key, count=False)
+            if output is not None:
+                return output
+            try:
+                completed_process = run_client('fullness', '--gym-name', gym_name)
+            except subprocess.CalledProcessError as e:
+                fullness_by_name.put_failure(key, e)
+                raise
+            output = completed_process.stderr + '\n' + completed_process.stdout
+            output = output.encode('utf-8')
+            fullness_by_name.put(key, output)
+            return output
+
+        output = fullness_by_name.get(key)
+        if output is None:
+            output = self._fills.do(('name', key), fill)
         return output
 
-    def _refresh_gyms(self) -> None:
-        if self._last_refreshed_gyms < datetime.now() - timedelta(days=1):
-            token = subprocess.check_output(['cat', token_path]).strip()
-            output = subprocess.check_output(
-                [puregym, 'all-gyms', '--bearer-token', token, '--terse', 'true'], text=True,
-                encoding='utf-8')
-            new_gyms = {}
-            for line in output.splitlines():
-                gym_id, gym_name = line.split(',')
-                new_gyms[int(gym_id)] = gym_name
-            self._all_gyms = new_gyms
-            self._last_refreshed_gyms = datetime.now()
+    def get_history(self, query: dict[AnyStr, list[AnyStr]]) -> None:
+        query_gym = query.get("gym_id", None)
+        if query_gym is None or len(query_gym) != 1:
+            self._bad_request('Send exactly one gym_id')
+            return
+        try:
+            gym_id = int(query_gym[0])
+        except ValueError:
+            self._bad_request('gym_id did not parse as an int')
+            return
+        since = 0.0
+        query_since = query.get("since", None)
+        if query_since is not None:
+            if len(query_since) != 1:
+                self._bad_request('Send only one since')
+                return
+            try:
+                since = float(query_since[0])
+            except ValueError:
+                try:
+                    since = datetime.fromisoformat(query_since[0]).timestamp()
+                except ValueError:
+                    self._bad_request('since must be a Unix time or an ISO 8601 datetime')
+                    return
 
-    def get_all_gyms(self, _query: dict[AnyStr, list[AnyStr]]) -> None:
-        self._refresh_gyms()
+        readings = fullness_history.since(gym_id, since)
+        if readings is None:
+            self._bad_request(f'No history for gym {gym_id}; only watched gyms are recorded', 404)
+            return
+        times, values = readings
+        result = {'gym_id': gym_id, 'readings': [[t, v] for t, v in zip(times, values)]}
+        result.update(summarise_fullness(times, values))
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(result).encode('utf-8'))
+
+    def get_cache_stats(self, _query: dict[AnyStr, list[AnyStr]]) -> None:
         self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-type', 'application/json')
         self.end_headers()
-        for gym_id, gym_name in self._all_gyms.items():
-            self.wfile.write(f'{gym_id}: {gym_name}\n'.encode())
+        stats = {'by_id': fullness_by_id.stats(), 'by_name': fullness_by_name.stats()}
+        self.wfile.write(json.dumps(stats).encode('utf-8'))
+
+    def get_all_gyms(self, _query: dict[AnyStr, list[AnyStr]]) -> None:
+        all_gyms = gym_directory.gyms()
+        rendered_from, body, gzipped = MyHandler._mapping_body
+        if rendered_from is not all_gyms:
+            # The mapping only changes daily, so render it (and compress it) once per change.
+            body = ''.join(f'{gym_id}: {gym_name}\n' for gym_id, gym_name in all_gyms.items()).encode()
+            gzipped = gzip.compress(body)
+            MyHandler._mapping_body = (all_gyms, body, gzipped)
+        expires = gym_directory.refreshed + gym_directory.ttl
+        self._send_cacheable(body, 'text/plain', gym_directory.refreshed, expires - datetime.now(), gzipped)
 
     def get_fullness(self, query: dict[AnyStr, list[AnyStr]]) -> None:
         desired_gym_name = None
@@ -84,28 +798,29 @@ class MyHandler(BaseHTTPRequestHandler):
         else:
             desired_gym_id = None
 
-        if desired_gym_id is not None:
-            output = self._get_fullness(desired_gym_id)
-        elif desired_gym_name is not None:
-            if abs(datetime.now() - self._last_accessed_by_name[desired_gym_name]) > timedelta(seconds=30):
-                token = subprocess.check_output(['cat', token_path]).strip()
-                completed_process = subprocess.run(
-                    [puregym, 'fullness', '--bearer-token', token, '--gym-name', desired_gym_name], text=True,
-                    encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-                output = completed_process.stderr + '\n' + completed_process.stdout
-                output = output.encode('utf-8')
-                self._cache_result_by_name[desired_gym_name] = output
-                self._last_accessed_by_name[desired_gym_name] = datetime.now()
+        try:
+            if desired_gym_id is not None:
+                output = self._get_fullness(desired_gym_id)
+                age = fullness_by_id.age(desired_gym_id)
+            elif desired_gym_name is not None:
+                gym_name, key = self._resolve_gym_name(desired_gym_name)
+                output = self._get_fullness_by_name(gym_name, key)
+                age = fullness_by_name.age(key)
             else:
-                output = self._cache_result_by_name[desired_gym_name]
-        else:
-            self._bad_request('Logic error: server reached impossible flow', 500)
+                self._bad_request('Logic error: server reached impossible flow', 500)
+                return
+        except subprocess.CalledProcessError as e:
+            # By name, the usual failure is a name PureGym doesn't know; by ID, it's PureGym itself.
+            self._bad_request(f'PureGym client failed: {describe_failure(e)}', 404 if desired_gym_id is None else 502)
+            return
+        except OSError as e:
+            self._bad_request(f'PureGym client could not be run: {e}', 502)
             return
 
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(output)
+        if age is None:
+            # Evicted since we read it; it was fresh a moment ago.
+            age = timedelta()
+        self._send_cacheable(output, 'text/plain; charset=utf-8', datetime.now() - age, result_ttl - age)
 
     def get_prometheus(self, query: dict[AnyStr, list[AnyStr]]) -> None:
         query_gym = query.get("gym_id", None)
@@ -122,24 +837,72 @@ class MyHandler(BaseHTTPRequestHandler):
             self._bad_request('supply at least one gym_id')
             return
 
+        def fetch(i: int) -> Optional[int]:
+            try:
+                return int(self._get_fullness(i).split(b' ')[0])
+            except (subprocess.CalledProcessError, OSError, ValueError) as e:
+                print(f'Scrape of gym {i} failed: {describe_failure(e)}', file=sys.stderr)
+                return None
+
+        start = time.monotonic()
+        gym_id = list(dict.fromkeys(gym_id))
+        # Cold gyms are fetched concurrently, so a scrape of many gyms costs about as much as one.
+        fullness = list(fetch_pool.map(fetch, gym_id))
+        fetch_seconds = time.monotonic() - start
         try:
-            fullness = [(i, int(self._get_fullness(i).split(b' ')[0])) for i in gym_id]
-        except ValueError:
-            self._bad_request('at least one fullness did not yield an int', 500)
-            return
+            all_gyms = gym_directory.gyms()
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f'Scrape has no gym names: {describe_failure(e)}', file=sys.stderr)
+            all_gyms = {}
+
+        now = time.time()
+        labels = ('gym_id', 'label')
+        lines = ['# HELP fullness People in the gym, as reported by PureGym.', '# TYPE fullness gauge']
+        age_lines = ['# HELP puregym_cache_age_seconds How old the fullness reported for each gym is.',
+                     '# TYPE puregym_cache_age_seconds gauge']
+        up_lines = ['# HELP puregym_fullness_up Whether the gym\'s fullness could be fetched for this scrape.',
+                    '# TYPE puregym_fullness_up gauge']
+        for i, value in zip(gym_id, fullness):
+            gym_name = ''.join(c for c in all_gyms.get(i, str(i)) if c == ' ' or str.isalnum(c))
+            gym_labels = format_labels(labels, (str(i), gym_name))
+            up_lines.append(f'puregym_fullness_up{gym_labels} {int(value is not None)}')
+            age = fullness_by_id.age(i)
+            if value is None or age is None:
+                continue
+            # Stamped with when the figure was fetched, not when it was scraped.
+            lines.append(f'fullness{gym_labels} {value} {int((now - age.total_seconds()) * 1000)}')
+            age_lines.append(f'puregym_cache_age_seconds{gym_labels} {age.total_seconds():.3f}')
+        lines += up_lines + age_lines
+
+        caches = {'by_id': fullness_by_id.stats(), 'by_name': fullness_by_name.stats()}
+        for stat, kind, documentation in [
+                ('hits', 'counter', 'Fullness lookups answered from the cache.'),
+                ('misses', 'counter', 'Fullness lookups that had to ask PureGym.'),
+                ('evictions', 'counter', 'Cache entries evicted to stay within the size limit.'),
+                ('entries', 'gauge', 'Entries in the cache.')]:
+            name = f'puregym_cache_{stat}_total' if kind == 'counter' else f'puregym_cache_{stat}'
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{format_labels(("cache",), (cache,))} {stats[stat]}' for cache, stats in caches.items()]
+        lines += metric_client_seconds.exposition()
+        lines += metric_client_failures.exposition()
+        lines += ['# HELP puregym_scrape_fetch_seconds Time this scrape spent waiting for fullness.',
+                  '# TYPE puregym_scrape_fetch_seconds gauge',
+                  f'puregym_scrape_fetch_seconds {fetch_seconds:.6f}',
+                  '# HELP puregym_scrape_seconds Time this scrape took to prepare, fetching included.',
+                  '# TYPE puregym_scrape_seconds gauge',
+                  f'puregym_scrape_seconds {time.monotonic() - start:.6f}']
 
         self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
         self.end_headers()
-        self._refresh_gyms()
-        for gym_id, fullness in fullness:
-            gym_name = ''.join(c for c in self._all_gyms[gym_id] if c == ' ' or str.isalnum(c))
-            self.wfile.write(f'fullness{{label="{gym_name}"}} {fullness}\n'.encode())
+        self.wfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
 
     _handlers: dict[str, Callable[["MyHandler", dict[AnyStr, list[AnyStr]]], None]] = {
         "/fullness": get_fullness,
         "/fullness-prometheus": get_prometheus,
+        "/fullness-history": get_history,
         "/gym-mapping": get_all_gyms,
+        "/cache-stats": get_cache_stats,
     }
 
     def do_GET(self):
@@ -152,9 +915,46 @@ class MyHandler(BaseHTTPRequestHandler):
             handler(self, params)
 
 
+def prefetch_forever(gym_ids: list[int], interval_seconds: float) -> None:
+    """Keep the watched gyms' fullness fresh, so that requests for them are answered from memory."""
+    while True:
+        for gym_id in gym_ids:
+            try:
+                MyHandler._fill_fullness(gym_id)
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f'Prefetch of gym {gym_id} failed: {describe_failure(e)}', file=sys.stderr)
+        # Jitter, so that we don't fall into lockstep with whoever is polling us.
+        time.sleep(interval_seconds * random.uniform(0.9, 1.1))
+
+
 if __name__ == '__main__':
     puregym = os.environ["PUREGYM_CLIENT"]
     port = int(os.environ["PUREGYM_PORT"])
-    token_path = os.environ["PUREGYM_TOKEN_PATH"]
-    server = HTTPServer(('0.0.0.0', port), MyHandler)
+    bearer_token = TokenFile(os.environ["PUREGYM_TOKEN_PATH"])
+    gym_directory = GymDirectory(os.environ.get("PUREGYM_GYM_SNAPSHOT"))
+    watched_gyms = {int(gym_id) for gym_id in os.environ.get("PUREGYM_WATCHED_GYMS", "").split(',') if gym_id}
+    fetch_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("PUREGYM_MAX_CONCURRENT_FETCHES", "4")))
+    max_staleness = timedelta(seconds=float(os.environ.get("PUREGYM_MAX_STALENESS_SECONDS", "300")))
+    result_ttl = timedelta(seconds=30)
+    cache_entries = int(os.environ.get("PUREGYM_CACHE_ENTRIES", "1000"))
+    negative_ttl = timedelta(seconds=float(os.environ.get("PUREGYM_NEGATIVE_TTL_SECONDS", "300")))
+    fullness_by_id = ResultCache(cache_entries, result_ttl, negative_ttl)
+    fullness_by_name = ResultCache(cache_entries, result_ttl, negative_ttl)
+    fullness_history = FullnessHistory(
+        int(os.environ.get("PUREGYM_HISTORY_READINGS", "20160")), os.environ.get("PUREGYM_HISTORY_PATH"))
+    threading.Thread(
+        target=fullness_history.save_forever,
+        args=(float(os.environ.get("PUREGYM_HISTORY_SAVE_SECONDS", "300")),),
+        daemon=True).start()
+    worker_args = os.environ.get("PUREGYM_WORKER_ARGS")
+    # One worker per concurrent fetch; unset, each query starts its own client process.
+    client_workers = None if not worker_args else ClientWorkerPool(
+        [puregym, *shlex.split(worker_args)], int(os.environ.get("PUREGYM_MAX_CONCURRENT_FETCHES", "4")),
+        float(os.environ.get("PUREGYM_WORKER_TIMEOUT_SECONDS", "30")))
+    if watched_gyms:
+        threading.Thread(
+            target=prefetch_forever,
+            args=(sorted(watched_gyms), float(os.environ.get("PUREGYM_PREFETCH_SECONDS", "60"))),
+            daemon=True).start()
+    server = ThreadingHTTPServer(('0.0.0.0', port), MyHandler)
     server.serve_forever()
@@ -3,16 +3,43 @@ Decrypt age-encrypted JSON secrets and deploy to /run/secrets/.
 
 Each secret in {"service": {"key": "value"}} becomes /run/secrets/service_key
 owned by service:service (with overrides for special cases).
+
+A manifest of each secret's digest and service is kept alongside, so a
+re-run only rewrites the secrets whose values (or ownership) changed, and
+reports which services they belong to, including those of removed secrets.
+
+/run/secrets is a symlink to a generation in /run/secrets.d/. Each run that
+changes anything stages a complete new generation and swaps the symlink, so
+nothing ever sees a partly written secret set. A changed secret is therefore
+a new file: a consumer that bind-mounts it (as the containers do) or reads it
+once keeps the old value until it restarts. Restarting the units of the
+affected services is part of deploying, via --restart-units.
+
+With --watch, it keeps running: whenever the encrypted file's contents change,
+it redeploys and restarts just the units of the affected services.
 """
 
 import argparse
+import contextlib
+import ctypes
+import fcntl
+import functools
 import grp
+import hashlib
 import json
 import os
 import pwd
+import select
+import shutil
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterator
 
 try:
     import bcrypt
@@ -24,6 +51,8 @@ DEFAULT_SERVICE_OWNERSHIP: dict[str, tuple[str, str]] = {
     "woodpecker": ("gitea", "gitea"),
 }
 
+MANIFEST_NAME = ".manifest.json"
+
 
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt for htpasswd."""
@@ -35,6 +64,36 @@ def hash_password(password: str) -> str:
     return hashed.decode('utf-8')
 
 
+def existing_password_hash(
+    filepath: Path, user: str, password: str
+) -> str | None:
+    """
+    The hash already deployed in an htpasswd file, if it's for this user and
+    still verifies against the password. Reusing it keeps the file unchanged,
+    where a fresh salt would make it look like a new secret on every run.
+    """
+    if bcrypt is None:
+        return None
+    try:
+        existing_user, existing_hash = filepath.read_text().split(":", 1)
+    except (OSError, ValueError):
+        return None
+    existing_hash = existing_hash.strip()
+    if existing_user != user:
+        return None
+    try:
+        if bcrypt.checkpw(password.encode('utf-8'), existing_hash.encode()):
+            return existing_hash
+    except ValueError:
+        # Not a bcrypt hash
+        pass
+    return None
+
+
+# Memoized: most secrets share a handful of owners, and each miss is an NSS
+# lookup (and a warning). deploy() clears both caches, so that a long-running
+# watcher notices users created since, rather than mapping them to root.
+@functools.cache
 def get_uid(name: str) -> int:
     try:
         return pwd.getpwnam(name).pw_uid
@@ -43,6 +102,7 @@ def get_uid(name: str) -> int:
         return 0
 
 
+@functools.cache
 def get_gid(name: str) -> int:
     try:
         return grp.getgrnam(name).gr_gid
@@ -77,6 +137,332 @@ def deploy_secret(
     os.chmod(filepath, mode)
 
 
+def value_digest(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def load_manifest(secrets_dir: Path) -> dict[str, dict[str, str]]:
+    """
+    Secret name -> {"service": ..., "sha256": digest of the value last
+    deployed}, if recorded.
+    """
+    try:
+        manifest = json.loads((secrets_dir / MANIFEST_NAME).read_text())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict):
+        return {}
+    for name, entry in manifest.items():
+        if isinstance(entry, str):
+            # Older manifests held only the digest. Secret names are
+            # service_key, so this is right unless the service has a "_".
+            manifest[name] = {"service": name.split("_", 1)[0],
+                              "sha256": entry}
+    return manifest
+
+
+def save_manifest(
+    secrets_dir: Path, manifest: dict[str, dict[str, str]]
+) -> None:
+    path = secrets_dir / MANIFEST_NAME
+    temp_path = secrets_dir / f"{MANIFEST_NAME}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(fd, json.dumps(manifest, sort_keys=True).encode())
+    finally:
+        os.close(fd)
+    os.replace(temp_path, path)
+
+
+def is_current(
+    filepath: Path, digest: str, deployed_digest: str | None,
+    uid: int, gid: int, mode: int
+) -> bool:
+    """Whether the file already holds this value, owner and mode."""
+    if digest != deployed_digest:
+        return False
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return False
+    return (st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)) == (uid, gid, mode)
+
+
+@dataclass
+class Secret:
+    service: str
+    name: str
+    value: str
+    owner: str
+    group: str
+    uid: int
+    gid: int
+    mode: int
+    # Set for htcrypt_password, whose file holds "user:bcrypt_hash"
+    htpasswd_user: str | None = None
+
+
+def plan_secrets(secrets: dict) -> list[Secret]:
+    """Resolve each secret's file name, ownership and mode."""
+    # Extract ownership overrides from _ownership key if present
+    ownership_config = secrets.pop("_ownership", {})
+    planned = []
+
+    for service, service_secrets in secrets.items():
+        # Default ownership: service user/group
+        default_owner, default_group = DEFAULT_SERVICE_OWNERSHIP.get(
+            service, (service, service)
+        )
+
+        for key, value in service_secrets.items():
+            secret_name = f"{service}_{key}"
+
+            # Check for custom ownership in _ownership config
+            if secret_name in ownership_config:
+                owner, group = ownership_config[secret_name]
+            else:
+                owner, group = default_owner, default_group
+
+            uid = get_uid(owner)
+            gid = get_gid(group)
+
+            # Database passwords owned by root need to be world-readable
+            # so postgres (via sudo) can read them
+            mode = 0o444 if uid == 0 else 0o440
+
+            # Special case: htcrypt_password needs to be combined with user
+            # into htpasswd format: "username:bcrypt_hash"
+            htpasswd_user = None
+            if key == "htcrypt_password" and "user" in service_secrets:
+                htpasswd_user = service_secrets['user']
+
+            planned.append(Secret(service, secret_name, value, owner, group,
+                                  uid, gid, mode, htpasswd_user))
+    return planned
+
+
+def render(secret: Secret, published_dir: Path) -> str:
+    """The file contents for a secret; hashing makes this the slow part."""
+    if secret.htpasswd_user is None:
+        return secret.value
+    user = secret.htpasswd_user
+    password_hash = existing_password_hash(
+        published_dir / secret.name, user, secret.value)
+    if password_hash is None:
+        password_hash = hash_password(secret.value)
+    return f"{user}:{password_hash}"
+
+
+def publish(secrets_dir: Path, staging: Path) -> None:
+    """
+    Point secrets_dir (a symlink) at the staged generation with a single
+    rename, so readers see either the old secret set or the new one, and
+    then delete the old generation.
+    """
+    previous = secrets_dir.resolve() if secrets_dir.is_symlink() else None
+    link = secrets_dir.with_name(f".{secrets_dir.name}.new")
+    link.unlink(missing_ok=True)
+    link.symlink_to(staging)
+    if secrets_dir.is_dir() and not secrets_dir.is_symlink():
+        # Left by an older version that wrote files in place. A symlink
+        # can't be renamed over a directory, so move it aside first.
+        previous = secrets_dir.with_name(f".{secrets_dir.name}.old")
+        shutil.rmtree(previous, ignore_errors=True)
+        os.rename(secrets_dir, previous)
+    os.replace(link, secrets_dir)
+    if previous is not None and previous != staging:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def materialise(secrets: dict, secrets_dir: Path, dry_run: bool) -> set[str]:
+    """
+    Write the secrets as a new generation beside secrets_dir and publish it
+    atomically, returning the services whose secrets changed or were
+    removed. Unchanged files are hard-linked into the new generation rather
+    than rewritten.
+    """
+    planned = plan_secrets(secrets)
+    deployed = load_manifest(secrets_dir)
+    # bcrypt releases the GIL, so hashing runs in parallel.
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        values = list(pool.map(lambda s: render(s, secrets_dir), planned))
+
+    manifest: dict[str, dict[str, str]] = {}
+    changed: list[tuple[Secret, str]] = []
+    for secret, value in zip(planned, values):
+        digest = value_digest(value)
+        manifest[secret.name] = {"service": secret.service, "sha256": digest}
+        if not is_current(secrets_dir / secret.name, digest,
+                          deployed.get(secret.name, {}).get("sha256"),
+                          secret.uid, secret.gid, secret.mode):
+            changed.append((secret, value))
+    removed = sorted(set(deployed) - set(manifest))
+    affected = {secret.service for secret, _ in changed}
+    affected.update(deployed[name]["service"] for name in removed)
+    print(f"{len(planned) - len(changed)} secrets unchanged")
+
+    for secret, value in changed:
+        mode_str = "0444" if secret.mode == 0o444 else "0440"
+        filepath = secrets_dir / secret.name
+        ownership = f"{secret.owner}:{secret.group}, {mode_str}"
+        if dry_run:
+            preview = value[:20] + "..." if len(value) > 20 else value
+            print(f"Would create {filepath} ({ownership}): {preview}")
+        else:
+            print(f"Created {filepath} ({ownership})")
+    for name in removed:
+        print(f"{'Would remove' if dry_run else 'Removed'} "
+              f"{secrets_dir / name}")
+
+    if dry_run or not (changed or removed):
+        return affected
+
+    generations = secrets_dir.with_name(f"{secrets_dir.name}.d")
+    generations.mkdir(mode=0o755, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix="gen-", dir=generations))
+    os.chmod(staging, 0o755)
+    changed_names = {secret.name for secret, _ in changed}
+    for secret, value in changed:
+        deploy_secret(staging / secret.name, value,
+                      secret.uid, secret.gid, secret.mode)
+    for secret in planned:
+        if secret.name not in changed_names:
+            os.link(secrets_dir / secret.name, staging / secret.name)
+    save_manifest(staging, manifest)
+    publish(secrets_dir, staging)
+    return affected
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def inotify_changes(path: Path, debounce: float) -> Iterator[None]:
+    """
+    Yield whenever `path` may have changed. The parent directory is watched,
+    since deploys replace the file by renaming over it, and a burst of events
+    yields once, after `debounce` seconds without any.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, str(path.parent).encode(), mask) < 0:
+        raise OSError(ctypes.get_errno(), f"Cannot watch {path.parent}")
+    while True:
+        data = os.read(fd, 65536)
+        offset = 0
+        relevant = False
+        while offset < len(data):
+            _wd, _mask, _cookie, length = INOTIFY_EVENT.unpack_from(
+                data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            relevant = relevant or name == path.name.encode()
+        if not relevant:
+            continue
+        # Wait for the burst to settle, discarding what arrives meanwhile
+        while select.select([fd], [], [], debounce)[0]:
+            os.read(fd, 65536)
+        yield
+
+
+def file_digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def deploy(args: argparse.Namespace) -> set[str] | None:
+    """
+    Decrypt and materialise the secrets, returning the affected services, or
+    None if decryption failed. Runs hold a lock, so a oneshot run and the
+    watcher can't publish over each other.
+    """
+    get_uid.cache_clear()
+    get_gid.cache_clear()
+    generations = args.secrets_dir.with_name(f"{args.secrets_dir.name}.d")
+    with contextlib.ExitStack() as stack:
+        if not args.dry_run:
+            generations.mkdir(mode=0o755, exist_ok=True)
+            lock = stack.enter_context(open(generations / ".lock", "w"))
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            secrets = decrypt_secrets(
+                args.encrypted_file, args.age_binary, args.key_file
+            )
+        except RuntimeError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return None
+        affected = materialise(secrets, args.secrets_dir, args.dry_run)
+    if affected:
+        print(f"Affected services: {' '.join(sorted(affected))}")
+    else:
+        print("No services affected")
+    return affected
+
+
+def restart_units(
+    affected: set[str], units_by_service: dict[str, list[str]],
+    dry_run: bool, block: bool = True
+) -> None:
+    """
+    Restart the running units of the affected services. Not reload: a
+    container@ unit's reload re-applies its configuration but leaves its
+    bind mounts, which still hold the old secret files. Without `block`,
+    the jobs are only queued: a run ordered before those units would
+    otherwise wait on jobs that are waiting on it.
+    """
+    units = sorted({unit for service in affected
+                    for unit in units_by_service.get(service, [])})
+    for service in sorted(affected - units_by_service.keys()):
+        print(f"No units configured for {service}, not restarting anything")
+    for unit in units:
+        if dry_run:
+            print(f"Would restart {unit}")
+            continue
+        # One at a time, so a unit missing on this host doesn't stop others
+        result = subprocess.run(
+            ["systemctl", "try-restart", unit,
+             *([] if block else ["--no-block"])],
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            error = result.stderr.decode().strip()
+            print(f"Failed to restart {unit}: {error}", file=sys.stderr)
+        elif block:
+            print(f"Restarted {unit}")
+        else:
+            print(f"Queued restart of {unit}")
+
+
+def watch(
+    args: argparse.Namespace, units_by_service: dict[str, list[str]]
+) -> int:
+    """Redeploy whenever the encrypted file's contents change."""
+    last_digest = file_digest(args.encrypted_file)
+    affected = deploy(args)
+    if affected is not None:
+        restart_units(affected, units_by_service, args.dry_run)
+    print(f"Watching {args.encrypted_file}", flush=True)
+    for _ in inotify_changes(args.encrypted_file, args.debounce):
+        try:
+            digest = file_digest(args.encrypted_file)
+        except FileNotFoundError:
+            continue
+        if digest == last_digest:
+            continue
+        print(f"{args.encrypted_file} changed, redeploying")
+        affected = deploy(args)
+        if affected is not None:
+            last_digest = digest
+            restart_units(affected, units_by_service, args.dry_run)
+        sys.stdout.flush()
+    return 0
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
         description="Deploy secrets from encrypted JSON"
@@ -109,6 +495,23 @@ def main() -> int:
         action="store_true",
         help="Print what would be done without writing",
     )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, redeploying when the encrypted file changes",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=1.0,
+        help="Seconds of quiet to wait for after a change (with --watch)",
+    )
+    parser.add_argument(
+        "--restart-units",
+        type=Path,
+        help="JSON mapping each service to the units to restart "
+        "when its secrets change",
+    )
     args = parser.parse_args()
 
     if not args.encrypted_file.exists():
@@ -119,60 +522,18 @@ def main() -> int:
         print(f"Error: {args.key_file} not found", file=sys.stderr)
         return 1
 
-    try:
-        secrets = decrypt_secrets(
-            args.encrypted_file, args.age_binary, args.key_file
-        )
-    except RuntimeError as e:
-        print(f"Error: {e}", file=sys.stderr)
-        return 1
-
-    if not args.dry_run:
-        args.secrets_dir.mkdir(mode=0o755, exist_ok=True)
-
-    # Extract ownership overrides from _ownership key if present
-    ownership_config = secrets.pop("_ownership", {})
-
-    for service, service_secrets in secrets.items():
-        # Default ownership: service user/group
-        default_owner, default_group = DEFAULT_SERVICE_OWNERSHIP.get(
-            service, (service, service)
-        )
-
-        for key, value in service_secrets.items():
-            filepath = args.secrets_dir / f"{service}_{key}"
-            secret_name = f"{service}_{key}"
-
-            # Check for custom ownership in _ownership config
-            if secret_name in ownership_config:
-                owner, group = ownership_config[secret_name]
-            else:
-                owner, group = default_owner, default_group
-
-            uid = get_uid(owner)
-            gid = get_gid(group)
-
-            # Special case: htcrypt_password needs to be combined with user
-            # into htpasswd format: "username:bcrypt_hash"
-            if key == "htcrypt_password" and "user" in service_secrets:
-                password_hash = hash_password(value)
-                value = f"{service_secrets['user']}:{password_hash}"
-
-            # Database passwords owned by root need to be world-readable
-            # so postgres (via sudo) can read them
-            mode = 0o444 if uid == 0 else 0o440
-
-            if args.dry_run:
-                preview = value[:20] + "..." if len(value) > 20 else value
-                mode_str = "0444" if mode == 0o444 else "0440"
-                msg = f"Would create {filepath} ({owner}:{group}, {mode_str})"
-                msg += f": {preview}"
-                print(msg)
-            else:
-                deploy_secret(filepath, value, uid, gid, mode)
-                mode_str = "0444" if mode == 0o444 else "0440"
-                print(f"Created {filepath} ({owner}:{group}, {mode_str})")
+    units_by_service = {}
+    if args.restart_units is not None:
+        units_by_service = json.loads(args.restart_units.read_text())
+    if args.watch:
+        return watch(args, units_by_service)
 
+    affected = deploy(args)
+    if affected is None:
+        return 1
+    # Run as a oneshot, which the units are ordered after: queue the restarts
+    # (a no-op at boot, when none of them is running yet).
+    restart_units(affected, units_by_service, args.dry_run, block=False)
     return 0
 
 
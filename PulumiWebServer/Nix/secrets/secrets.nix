@@ -10,6 +10,20 @@
     pkgs.writers.writePython3Bin "deploy-secrets"
     {libraries = ps: [ps.bcrypt];}
     (builtins.readFile ./deploy-secrets.py);
+
+  deployArgs = [
+    (toString cfg.encryptedSecretsFile)
+    "--age-binary"
+    "${pkgs.age}/bin/age"
+    "--key-file"
+    (toString cfg.ageKeyFile)
+    "--secrets-dir"
+    cfg.secretsDir
+    "--restart-units"
+    "${restartUnitsFile}"
+  ];
+
+  restartUnitsFile = pkgs.writeText "secrets-restart-units.json" (builtins.toJSON cfg.restartUnits);
 in {
   options.services.json-secrets = {
     enable = lib.mkEnableOption "JSON-based secrets management";
@@ -31,6 +45,26 @@ in {
       default = "/run/secrets";
       description = "Directory where decrypted secrets are placed";
     };
+
+    watch = lib.mkEnableOption "redeploying secrets as soon as the encrypted file changes, restarting only the affected units";
+
+    restartUnits = lib.mkOption {
+      type = lib.types.attrsOf (lib.types.listOf lib.types.str);
+      default = {
+        gitea = ["gitea-db-password.service" "container@gitea.service"];
+        grafana = ["container@grafana.service"];
+        miniflux = ["miniflux-db-password.service" "container@miniflux.service"];
+        onatrain = ["container@onatrain.service"];
+        puregym = ["container@puregym.service"];
+        radicale = ["container@radicale.service"];
+        robocop = ["container@robocop.service"];
+        woodpecker = ["woodpecker-secret.service" "woodpecker-server.service" "woodpecker-agent-docker-agent.service"];
+      };
+      description = ''
+        The units to restart when a service's secrets change or are removed, keyed by the service name in the secrets JSON.
+        A changed secret is a new file, so a unit that bind-mounts or caches it only sees the new value once restarted.
+      '';
+    };
   };
 
   config = lib.mkIf cfg.enable {
@@ -56,16 +90,25 @@ in {
       serviceConfig = {
         Type = "oneshot";
         RemainAfterExit = true;
-        ExecStart = lib.concatStringsSep " " [
-          "${deployScript}/bin/deploy-secrets"
-          (toString cfg.encryptedSecretsFile)
-          "--age-binary"
-          "${pkgs.age}/bin/age"
-          "--key-file"
-          (toString cfg.ageKeyFile)
-          "--secrets-dir"
-          cfg.secretsDir
-        ];
+        ExecStart = lib.concatStringsSep " " (["${deployScript}/bin/deploy-secrets"] ++ deployArgs);
+      };
+    };
+
+    # The oneshot above still materialises secrets at boot, before their consumers start;
+    # this picks up later deploys. Units that aren't running are left alone.
+    systemd.services.json-secrets-watch = lib.mkIf cfg.watch {
+      description = "Redeploy secrets when they change";
+      wantedBy = ["multi-user.target"];
+      after = ["json-secrets.service"];
+      wants = ["json-secrets.service"];
+      serviceConfig = {
+        Restart = "always";
+        Type = "exec";
+        ExecStart = lib.concatStringsSep " " (
+          ["${deployScript}/bin/deploy-secrets"]
+          ++ deployArgs
+          ++ ["--watch"]
+        );
       };
     };
 
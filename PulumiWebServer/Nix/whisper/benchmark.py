@@ -0,0 +1,60 @@
+"""
+Compare the wall-clock time of transcribing a normalized WAV with a single whisper-cpp process
+against the chunked path, which transcribes silence-aligned segments in parallel.
+
+Usage:
+    python benchmark.py /path/to/whisper-cpp recording.wav --workers 4
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import whisper as server
+
+
+def time_run(generate, wav_path: str) -> tuple[float, int]:
+    # The generators consume their upload, so give each run its own copy.
+    os.makedirs("/tmp/whisper", exist_ok=True)
+    wav_file = uuid.uuid4().hex
+    shutil.copyfile(wav_path, f"/tmp/whisper/{wav_file}.wav")
+    ticket = server.scheduler.submit()
+    start = time.monotonic()
+    lines = sum(1 for event in generate(wav_file, ticket, wav_file, lambda: False)
+                if event is not None and event[0] == "message")
+    return time.monotonic() - start, lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark single-process against chunked transcription")
+    parser.add_argument("whisper_client", help="Path to the whisper-cpp binary")
+    parser.add_argument("wav", help="A WAV as produced by normalize.sh")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--segment-seconds", type=float, default=server.segment_seconds)
+    parser.add_argument("--cut-search-seconds", type=float,
+                        help="How far either side of each target to look for silence "
+                             "(default: the server's, scaled with --segment-seconds)")
+    args = parser.parse_args()
+    if args.cut_search_seconds is None:
+        args.cut_search_seconds = server.cut_search_seconds * args.segment_seconds / server.segment_seconds
+
+    server.whisper = args.whisper_client
+    server.segment_seconds = args.segment_seconds
+    server.cut_search_seconds = args.cut_search_seconds
+    server.scheduler = server.JobScheduler(workers=args.workers, max_queued=0)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        server.transcript_cache = server.TranscriptCache(cache_dir, max_bytes=1024 * 1024 * 1024)
+
+        single, single_lines = time_run(server.generate_output, args.wav)
+        print(f"single process: {single:.1f}s, {single_lines} lines")
+        chunked, chunked_lines = time_run(server.generate_chunked_output, args.wav)
+        print(f"chunked ({args.workers} workers, {args.segment_seconds:g}s segments): "
+              f"{chunked:.1f}s, {chunked_lines} lines")
+        print(f"speedup: {single / chunked:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
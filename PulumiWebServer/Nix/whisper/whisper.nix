@@ -22,6 +22,36 @@
         description = lib.mdDoc "Whisper localhost port to be forwarded";
         default = 1739;
       };
+      server = lib.mkOption {
+        type = lib.types.enum ["waitress" "asgi"];
+        description = lib.mdDoc "HTTP server: waitress uses a thread per open transcription stream, asgi serves them all from one event loop";
+        default = "waitress";
+      };
+      workers = lib.mkOption {
+        type = lib.types.nullOr lib.types.ints.positive;
+        description = lib.mdDoc "Maximum number of concurrent whisper-cpp processes; defaults to the number of cores";
+        default = null;
+      };
+      cacheBytes = lib.mkOption {
+        type = lib.types.ints.positive;
+        description = lib.mdDoc "Size limit of the on-disk transcript cache, in bytes";
+        default = 256 * 1024 * 1024;
+      };
+      tmpTtlSeconds = lib.mkOption {
+        type = lib.types.ints.positive;
+        description = lib.mdDoc "Age after which uploaded files without a running transcription are deleted";
+        default = 6 * 60 * 60;
+      };
+      tmpQuotaBytes = lib.mkOption {
+        type = lib.types.ints.positive;
+        description = lib.mdDoc "Total size of uploaded files to keep; the oldest are deleted first, and uploads are refused if it can't be met";
+        default = 1024 * 1024 * 1024;
+      };
+      maxQueue = lib.mkOption {
+        type = lib.types.ints.unsigned;
+        description = lib.mdDoc "Maximum number of transcriptions waiting for a worker before new ones are refused with 503";
+        default = 8;
+      };
     };
   };
 
@@ -35,21 +65,34 @@
       description = "whisper-server";
       wantedBy = ["multi-user.target"];
       serviceConfig = let
-        python = pkgs.python3.withPackages (p: with p; [flask waitress]);
+        python = pkgs.python3.withPackages (p: with p; [a2wsgi flask prometheus-client uvicorn waitress]);
       in {
         Restart = "always";
         Type = "exec";
         User = "whisper";
         Group = "whisper";
         ExecStart = "${python}/bin/python ${./whisper.py}";
+        CacheDirectory = "whisper";
+        StateDirectory = "whisper";
       };
-      environment = {
-        WHISPER_NORMALIZE = "${whisper-packages.normalize}/bin/normalize.sh";
-        WHISPER_CLIENT = "${whisper-packages.default}/bin/whisper-cpp";
-        WHISPER_PORT = toString config.services.whisper-config.port;
-        INDEX_PAGE_PATH = ./transcribe.html;
-        YT_DLP = "${pkgs.yt-dlp}/bin/yt-dlp";
-      };
+      environment =
+        {
+          WHISPER_NORMALIZE = "${whisper-packages.normalize}/bin/normalize.sh";
+          WHISPER_CLIENT = "${whisper-packages.default}/bin/whisper-cpp";
+          WHISPER_PORT = toString config.services.whisper-config.port;
+          WHISPER_SERVER = config.services.whisper-config.server;
+          WHISPER_MAX_QUEUE = toString config.services.whisper-config.maxQueue;
+          WHISPER_CACHE_DIR = "/var/cache/whisper";
+          WHISPER_CACHE_BYTES = toString config.services.whisper-config.cacheBytes;
+          WHISPER_JOB_DIR = "/var/lib/whisper/jobs";
+          WHISPER_TMP_TTL_SECONDS = toString config.services.whisper-config.tmpTtlSeconds;
+          WHISPER_TMP_QUOTA_BYTES = toString config.services.whisper-config.tmpQuotaBytes;
+          INDEX_PAGE_PATH = ./transcribe.html;
+          YT_DLP = "${pkgs.yt-dlp}/bin/yt-dlp";
+        }
+        // lib.optionalAttrs (config.services.whisper-config.workers != null) {
+          WHISPER_WORKERS = toString config.services.whisper-config.workers;
+        };
     };
 
     services.nginx.proxyTimeout = "300s";
@@ -60,6 +103,27 @@
       locations."/" = {
         proxyPass = "http://localhost:${toString config.services.whisper-config.port}/";
       };
+      # Metrics are for the Prometheus container only.
+      locations."/metrics" = {
+        return = "404";
+      };
     };
+
+    # Let the Prometheus container reach the server over the bridge.
+    networking.firewall.interfaces."ve-+".allowedTCPPorts = [config.services.whisper-config.port];
+
+    services.prometheus-container.extraScrapeConfigs = [
+      {
+        job_name = "whisper";
+        static_configs = [
+          {
+            # The host's address on the container bridge
+            targets = ["192.168.100.1:${toString config.services.whisper-config.port}"];
+          }
+        ];
+        metrics_path = "/metrics";
+        scrape_interval = "30s";
+      }
+    ];
   };
 }
@@ -1,10 +1,24 @@
+import asyncio
 import subprocess
 import os
-from typing import AnyStr
+import hashlib
+import json
+import queue
+import signal
+import threading
+import time
+import wave
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from typing import AnyStr, Awaitable, Callable, Generator, Iterator, Optional
+from urllib.parse import parse_qs
 import re
-from flask import Flask, Response, request, render_template_string
+import uuid
+from flask import Flask, Response, g, request, render_template_string, send_file
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
 import waitress
-import tempfile
 
 app = Flask(__name__)
 
@@ -13,20 +27,896 @@ youtube_regex = re.compile(
 
 acceptable_regex = re.compile(r"^[a-zA-Z0-9_]+$")
 
+# Flags passed to every whisper-cpp run; part of the transcript cache key.
+whisper_flags = ["--output-txt"]
 
-def generate_output(wav_file):
-    process = subprocess.Popen([whisper, "--file", f"/tmp/whisper/{wav_file}.wav", "--output-txt"],
-                               stdout=subprocess.PIPE, bufsize=1,
-                               text=True)
+upload_chunk_size = 64 * 1024
 
-    yield f'event: started\ndata: {wav_file}\n\n'
+# How often an otherwise silent event stream is written to, so that a vanished client is noticed.
+heartbeat_seconds = 5.0
 
-    for line in iter(process.stdout.readline, ''):
-        yield f"data: {line}\n\n"
+# How long a transcription keeps running with nobody watching it, in case they reconnect.
+job_grace_seconds = 60.0
 
-    yield 'event: quit\ndata: \n\n'
+# Chunked transcription: target segment length, how far either side of each target to look for the
+# quietest point to cut at, and how much audio each segment shares with its neighbours.
+segment_seconds = 300.0
+cut_search_seconds = 10.0
+segment_overlap_seconds = 2.0
 
-    os.remove(f"/tmp/whisper/{wav_file}.wav")
+metric_upload_bytes = Histogram(
+    "whisper_upload_bytes", "Size of uploaded files before normalization",
+    buckets=[2 ** i * 1024 * 1024 for i in range(-2, 7)])
+metric_normalize_seconds = Histogram(
+    "whisper_normalize_duration_seconds", "Time to receive and normalize an upload",
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+metric_transcription_seconds = Histogram(
+    "whisper_transcription_duration_seconds", "Wall time of successful transcriptions, excluding queueing",
+    ["mode"], buckets=(5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+metric_realtime_factor = Histogram(
+    "whisper_transcription_realtime_factor", "Seconds of audio transcribed per second of wall time",
+    ["mode"], buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+metric_request_seconds = Histogram(
+    "whisper_request_duration_seconds", "Time to produce each response; for event streams, until the stream begins",
+    ["endpoint"])
+
+timestamp_regex = re.compile(
+    r"^\[(\d+):(\d+):(\d+(?:\.\d+)?) --> (\d+):(\d+):(\d+(?:\.\d+)?)\](.*)$", re.DOTALL)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self):
+        self.running = False
+
+
+class JobScheduler:
+    """
+    Admits whisper-cpp runs in FIFO order: at most `workers` run at once, and at most
+    `max_queued` more may wait for a slot. Everything else is refused outright.
+    """
+
+    def __init__(self, workers: int, max_queued: int):
+        self._workers = workers
+        self._max_queued = max_queued
+        self._active = 0
+        self._waiting: deque[Ticket] = deque()
+        self._cond = threading.Condition()
+
+    def submit(self) -> Ticket:
+        with self._cond:
+            if len(self._waiting) >= self._max_queued and self._active >= self._workers:
+                raise QueueFullError()
+            ticket = Ticket()
+            self._waiting.append(ticket)
+            self._promote()
+            return ticket
+
+    def wait(self, ticket: Ticket, timeout: float) -> Optional[int]:
+        """Wait up to `timeout` seconds for a slot. Returns the 1-based queue position if still waiting."""
+        with self._cond:
+            if not ticket.running:
+                self._cond.wait(timeout)
+            if ticket.running:
+                return None
+            return self._waiting.index(ticket) + 1
+
+    def workers(self) -> int:
+        return self._workers
+
+    def active(self) -> int:
+        with self._cond:
+            return self._active
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._waiting)
+
+    def try_acquire(self) -> Optional[Ticket]:
+        """Take a worker slot without queueing, but only if one is idle and no job is waiting for it."""
+        with self._cond:
+            if self._waiting or self._active >= self._workers:
+                return None
+            ticket = Ticket()
+            ticket.running = True
+            self._active += 1
+            return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """Give up the ticket's slot (or its place in the queue, if it never started)."""
+        with self._cond:
+            if ticket.running:
+                ticket.running = False
+                self._active -= 1
+            else:
+                try:
+                    self._waiting.remove(ticket)
+                except ValueError:
+                    pass
+            self._promote()
+
+    def _promote(self) -> None:
+        while self._waiting and self._active < self._workers:
+            ticket = self._waiting.popleft()
+            ticket.running = True
+            self._active += 1
+        self._cond.notify_all()
+
+
+class TranscriptCache:
+    """
+    On-disk transcripts keyed by (normalized audio digest, whisper binary, flags).
+    Least-recently-used entries are evicted once the total size exceeds `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for name in os.listdir(directory):
+            if name.endswith(".txt"):
+                st = os.stat(os.path.join(directory, name))
+                existing.append((st.st_mtime, name[:-len(".txt")], st.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def key(audio_digest: str, *mode: str) -> str:
+        h = hashlib.sha256()
+        for part in [audio_digest, whisper, *whisper_flags, *mode]:
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.txt")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    transcript = f.read()
+            except FileNotFoundError:
+                self._total_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            os.utime(self._path(key))
+            self.hits += 1
+            return transcript
+
+    def put(self, key: str, transcript: str) -> None:
+        data = transcript.encode("utf-8")
+        with self._lock:
+            temp_path = f"{self._path(key)}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total_bytes > self._max_bytes and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "bytes": self._total_bytes}
+
+
+# Digest of each normalized upload, so the cache lookup doesn't have to re-read the WAV.
+upload_digests: dict[str, str] = {}
+
+
+def remove_upload(wav_file) -> None:
+    try:
+        os.remove(f"/tmp/whisper/{wav_file}.wav")
+    except FileNotFoundError:
+        pass
+    upload_digests.pop(wav_file, None)
+
+
+class TempJanitor:
+    """
+    Keeps the upload directory within a TTL and a total-size quota, removing the oldest files first.
+    Files of a pinned upload (one being written, or with a transcription attached) are never removed.
+    """
+
+    def __init__(self, directory: str, ttl_seconds: float, quota_bytes: int):
+        self._directory = directory
+        self._ttl_seconds = ttl_seconds
+        self._quota_bytes = quota_bytes
+        self._pins: defaultdict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def pin(self, name: str) -> None:
+        with self._lock:
+            self._pins[name] += 1
+
+    def unpin(self, name: str) -> None:
+        with self._lock:
+            self._pins[name] -= 1
+            if self._pins[name] <= 0:
+                del self._pins[name]
+
+    def total_bytes(self) -> int:
+        total = 0
+        try:
+            with os.scandir(self._directory) as entries:
+                for entry in entries:
+                    try:
+                        total += entry.stat().st_size
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return total
+
+    def _sweep(self, needed_bytes: int) -> bool:
+        files = []
+        try:
+            with os.scandir(self._directory) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, entry.name))
+        except FileNotFoundError:
+            pass
+
+        now = time.time()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, name in sorted(files):
+            stem = name.split('.', 1)[0]
+            if stem in self._pins:
+                continue
+            if now - mtime > self._ttl_seconds or total + needed_bytes > self._quota_bytes:
+                try:
+                    os.remove(os.path.join(self._directory, name))
+                except FileNotFoundError:
+                    pass
+                upload_digests.pop(stem, None)
+                total -= size
+        return total + needed_bytes <= self._quota_bytes
+
+    def admit(self, needed_bytes: int) -> bool:
+        """Evict as needed to make room for `needed_bytes` more; False if pinned files leave too little."""
+        with self._lock:
+            return self._sweep(needed_bytes)
+
+    def run_forever(self, interval_seconds: float) -> None:
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                with self._lock:
+                    self._sweep(0)
+            except OSError as e:
+                print(f"janitor sweep failed: {e}", flush=True)
+
+    def start(self, interval_seconds: float = 60) -> None:
+        threading.Thread(target=self.run_forever, args=(interval_seconds,), daemon=True).start()
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def wav_digest(wav_file) -> str:
+    digest = upload_digests.get(wav_file)
+    if digest is None:
+        digest = file_digest(f"/tmp/whisper/{wav_file}.wav")
+        upload_digests[wav_file] = digest
+    return digest
+
+
+class ServerCollector:
+    """Reports the scheduler's, cache's and upload directory's current state at scrape time."""
+
+    def collect(self):
+        yield GaugeMetricFamily("whisper_workers", "Size of the worker pool", value=scheduler.workers())
+        yield GaugeMetricFamily("whisper_active_workers", "Worker slots in use", value=scheduler.active())
+        yield GaugeMetricFamily("whisper_queue_depth", "Transcriptions waiting for a worker", value=scheduler.queued())
+        yield GaugeMetricFamily("whisper_tmp_bytes", "Total size of files in /tmp/whisper", value=janitor.total_bytes())
+        stats = transcript_cache.stats()
+        yield CounterMetricFamily("whisper_transcript_cache_hits", "Transcript cache hits", value=stats["hits"])
+        yield CounterMetricFamily("whisper_transcript_cache_misses", "Transcript cache misses", value=stats["misses"])
+        yield GaugeMetricFamily("whisper_transcript_cache_bytes", "Size of the transcript cache", value=stats["bytes"])
+
+
+def wav_duration(path: str) -> float:
+    with wave.open(path, 'rb') as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def observe_transcription(mode: str, wav_path: str, started: float) -> None:
+    elapsed = time.monotonic() - started
+    metric_transcription_seconds.labels(mode).observe(elapsed)
+    try:
+        metric_realtime_factor.labels(mode).observe(wav_duration(wav_path) / max(elapsed, 1e-3))
+    except (OSError, EOFError, wave.Error):
+        pass
+
+
+# A transcription event: its SSE event name ("message" for transcript lines) and data.
+Event = tuple[str, str]
+
+
+def generate_cached_output(wav_file, transcript: str) -> Iterator[Optional[Event]]:
+    try:
+        yield "started", wav_file
+
+        for line in transcript.splitlines(keepends=True):
+            yield "message", line
+
+        yield "quit", ""
+    finally:
+        remove_upload(wav_file)
+
+
+def read_lines(stream, timeout: float) -> Iterator[Optional[str]]:
+    """
+    Start reading lines from `stream` in the background. The returned iterator yields them,
+    or None whenever `timeout` seconds pass without one.
+    """
+    lines: queue.Queue[str] = queue.Queue()
+
+    def pump():
+        for line in iter(stream.readline, ''):
+            lines.put(line)
+        lines.put('')
+
+    def drain():
+        while True:
+            try:
+                line = lines.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if line == '':
+                return
+            yield line
+
+    threading.Thread(target=pump, daemon=True).start()
+    return drain()
+
+
+def kill_process_tree(process: subprocess.Popen) -> None:
+    """Stop a process started with start_new_session=True, along with anything it spawned."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+
+def wait_for_worker(ticket: Ticket, cancelled: Callable[[], bool]) -> Generator[Optional[Event], None, bool]:
+    """Yield queue-position events until `ticket` runs. Returns False if the job was cancelled first."""
+    last_position = None
+    while (position := scheduler.wait(ticket, heartbeat_seconds)) is not None:
+        if cancelled():
+            return False
+        if position != last_position:
+            yield "queued", str(position)
+            last_position = position
+    return True
+
+
+def generate_output(wav_file, ticket: Ticket, cache_key: str,
+                    cancelled: Callable[[], bool]) -> Iterator[Optional[Event]]:
+    """
+    Yields None periodically while nothing is happening. Once `cancelled()` (checked on every step),
+    the generator returns early; then, or if it is closed, the finally block kills whisper-cpp,
+    frees the worker slot and deletes the upload.
+    """
+    process = None
+    try:
+        if not (yield from wait_for_worker(ticket, cancelled)):
+            return
+
+        started = time.monotonic()
+        process = subprocess.Popen([whisper, "--file", f"/tmp/whisper/{wav_file}.wav", *whisper_flags],
+                                   stdout=subprocess.PIPE, bufsize=1,
+                                   text=True, start_new_session=True)
+
+        yield "started", wav_file
+
+        lines = []
+        for line in read_lines(process.stdout, heartbeat_seconds):
+            if cancelled():
+                return
+            if line is None:
+                yield None
+                continue
+            lines.append(line)
+            yield "message", line
+        if process.wait() == 0:
+            observe_transcription("single", f"/tmp/whisper/{wav_file}.wav", started)
+            transcript_cache.put(cache_key, ''.join(lines))
+
+        yield "quit", ""
+    finally:
+        if process is not None and process.poll() is None:
+            kill_process_tree(process)
+        scheduler.release(ticket)
+        remove_upload(wav_file)
+
+
+class Segment:
+    """
+    A slice of an upload, written to its own WAV. Its audio starts at `offset` seconds into the upload,
+    but only transcript lines starting within [`start`, `end`) belong to it; the rest is overlap.
+    """
+
+    def __init__(self, path: str, offset: float, start: float, end: float):
+        self.path = path
+        self.offset = offset
+        self.start = start
+        self.end = end
+
+    def rebase(self, line: str) -> Optional[str]:
+        """Shift a whisper-cpp output line onto the upload's timeline; None if it belongs to a neighbour."""
+        match = timestamp_regex.match(line)
+        if match is None:
+            return line
+        start = self.offset + int(match[1]) * 3600 + int(match[2]) * 60 + float(match[3])
+        end = self.offset + int(match[4]) * 3600 + int(match[5]) * 60 + float(match[6])
+        if not self.start <= start < self.end:
+            return None
+        return f"[{format_timestamp(start)} --> {format_timestamp(end)}]{match[7]}"
+
+
+def format_timestamp(seconds: float) -> str:
+    millis = round(seconds * 1000)
+    return f"{millis // 3600000:02d}:{millis // 60000 % 60:02d}:{millis // 1000 % 60:02d}.{millis % 1000:03d}"
+
+
+def quietest_frame(wav: wave.Wave_read, around: int, search: int) -> int:
+    """The frame within `search` frames of `around` at the centre of the quietest 100ms window."""
+    window = wav.getframerate() // 10
+    lo = max(0, around - search)
+    hi = min(wav.getnframes(), around + search)
+    wav.setpos(lo)
+    samples = array('h')
+    samples.frombytes(wav.readframes(hi - lo))
+    step = window * wav.getnchannels()
+    best, best_energy = around, None
+    for i in range(0, len(samples) - step + 1, step):
+        energy = sum(x * x for x in samples[i:i + step])
+        if best_energy is None or energy < best_energy:
+            best, best_energy = lo + i // wav.getnchannels() + window // 2, energy
+    return best
+
+
+def split_at_silence(wav_file) -> list[Segment]:
+    """Cut an upload near every `segment_seconds`, at the quietest nearby point, into overlapping segments."""
+    path = f"/tmp/whisper/{wav_file}.wav"
+    with wave.open(path, 'rb') as wav:
+        rate = wav.getframerate()
+        frames = wav.getnframes()
+        cuts = [0]
+        target = int(segment_seconds * rate)
+        # Searching further than a quarter segment either side could cut right after the previous cut.
+        search = min(int(cut_search_seconds * rate), target // 4)
+        while cuts[-1] + target * 1.5 < frames:
+            if wav.getsampwidth() == 2:
+                cuts.append(quietest_frame(wav, cuts[-1] + target, search))
+            else:
+                cuts.append(cuts[-1] + target)
+        cuts.append(frames)
+        if len(cuts) == 2:
+            return [Segment(path, 0.0, 0.0, frames / rate)]
+
+        overlap = int(segment_overlap_seconds * rate)
+        segments = []
+        for index, (start, end) in enumerate(zip(cuts, cuts[1:])):
+            audio_start = max(0, start - overlap)
+            audio_end = min(frames, end + overlap)
+            # Named so that the janitor treats the segment as part of the upload it came from.
+            segment_path = f"/tmp/whisper/{wav_file}.part{index}.wav"
+            wav.setpos(audio_start)
+            with wave.open(segment_path, 'wb') as out:
+                out.setparams(wav.getparams())
+                out.writeframes(wav.readframes(audio_end - audio_start))
+            segments.append(Segment(segment_path, audio_start / rate, start / rate, end / rate))
+        return segments
+
+
+class SegmentRun:
+    """A whisper-cpp process for one segment, on the job's own worker slot if `ticket` is None."""
+
+    def __init__(self, segment: Segment, ticket: Optional[Ticket]):
+        self.segment = segment
+        self.ticket = ticket
+        self.process = subprocess.Popen([whisper, "--file", segment.path, *whisper_flags],
+                                        stdout=subprocess.PIPE, bufsize=1,
+                                        text=True, start_new_session=True)
+        self.lines = read_lines(self.process.stdout, heartbeat_seconds)
+
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+
+def generate_chunked_output(wav_file, ticket: Ticket, cache_key: str,
+                            cancelled: Callable[[], bool]) -> Iterator[Optional[Event]]:
+    """
+    Like generate_output, but transcribes silence-aligned segments of the upload concurrently.
+    The job always has its own worker slot, and borrows idle ones from the pool for further segments.
+    Output is emitted in timeline order, so later segments are buffered until their predecessors finish.
+    """
+    runs: list[SegmentRun] = []
+    segments: list[Segment] = []
+    try:
+        if not (yield from wait_for_worker(ticket, cancelled)):
+            return
+
+        started = time.monotonic()
+        segments = split_at_silence(wav_file)
+        pending = deque(segments)
+
+        def top_up():
+            for run in runs:
+                if run.ticket is not None and not run.running():
+                    scheduler.release(run.ticket)
+            while pending:
+                borrowed = None
+                if any(run.ticket is None and run.running() for run in runs):
+                    borrowed = scheduler.try_acquire()
+                    if borrowed is None:
+                        return
+                runs.append(SegmentRun(pending.popleft(), borrowed))
+
+        top_up()
+        yield "started", wav_file
+
+        lines = []
+        succeeded = True
+        # Segments are started in order, and the job's own slot frees up whenever the segment being
+        # emitted finishes, so runs[index] always exists by the time we reach it.
+        for index in range(len(segments)):
+            run = runs[index]
+            for line in run.lines:
+                if cancelled():
+                    return
+                top_up()
+                if line is None:
+                    yield None
+                    continue
+                line = run.segment.rebase(line)
+                if line is not None:
+                    lines.append(line)
+                    yield "message", line
+            if run.process.wait() != 0:
+                succeeded = False
+            top_up()
+        if succeeded:
+            observe_transcription("chunked", f"/tmp/whisper/{wav_file}.wav", started)
+            transcript_cache.put(cache_key, ''.join(lines))
+
+        yield "quit", ""
+    finally:
+        for run in runs:
+            if run.running():
+                kill_process_tree(run.process)
+            if run.ticket is not None:
+                scheduler.release(run.ticket)
+        scheduler.release(ticket)
+        for segment in segments:
+            if segment.path != f"/tmp/whisper/{wav_file}.wav":
+                try:
+                    os.remove(segment.path)
+                except FileNotFoundError:
+                    pass
+        remove_upload(wav_file)
+
+
+class Job:
+    """
+    One transcription, driven by its own thread whatever happens to the clients watching it.
+    Events are kept in memory and appended to a log file, so a client can join late, or resume
+    after a dropped connection from the last event it saw. Once nobody has been watching for
+    `job_grace_seconds`, the job reports itself cancelled.
+    """
+
+    def __init__(self, job_id: str, wav_file, log_path: str, events: Optional[list[Event]] = None,
+                 finished: bool = False):
+        self.id = job_id
+        self.wav_file = wav_file
+        self._log_path = log_path
+        self._events: list[Event] = events or []
+        self._finished = finished
+        self.finished_at = time.monotonic() if finished else None
+        self._followers = 0
+        self._unwatched_since: Optional[float] = time.monotonic()
+        self._cond = threading.Condition()
+        # Followers on an event loop, woken thread-safely instead of through the condition.
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    @staticmethod
+    def load(job_id: str, log_path: str) -> "Job":
+        """
+        A job from a previous run of the server, as far as its log got. A job that server died in the middle
+        of is recorded as failed, so that clients stop waiting for it to end.
+        """
+        events = []
+        with open(log_path, "r+b") as log:
+            complete = 0
+            for line in log:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated line")
+                    name, data = json.loads(line)
+                except ValueError:
+                    # The server stopped mid-write.
+                    break
+                events.append((name, data))
+                complete += len(line)
+            if not events or events[-1][0] not in ("quit", "failed"):
+                event = ("failed", "interrupted by a server restart")
+                events.append(event)
+                log.seek(complete)
+                log.truncate()
+                log.write((json.dumps(event) + "\n").encode("utf-8"))
+        return Job(job_id, None, log_path, events, finished=True)
+
+    def run(self, events: Iterator[Optional[Event]]) -> None:
+        with open(self._log_path, "a", encoding="utf-8") as log:
+            def append(event: Event) -> None:
+                log.write(json.dumps(event) + "\n")
+                log.flush()
+                with self._cond:
+                    self._events.append(event)
+                    self._notify()
+
+            try:
+                append(("job", self.id))
+                for event in events:
+                    if event is not None:
+                        append(event)
+                if self._events[-1][0] != "quit":
+                    append(("failed", "cancelled: nobody was watching"))
+            except Exception as e:
+                print(f"job {self.id} failed: {e!r}", flush=True)
+                append(("failed", str(e)))
+            finally:
+                with self._cond:
+                    self._finished = True
+                    self.finished_at = time.monotonic()
+                    self._notify()
+
+    def _notify(self) -> None:
+        self._cond.notify_all()
+        for loop, woken in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(woken.set)
+            except RuntimeError:
+                # That loop has been closed.
+                pass
+
+    def attach(self) -> None:
+        with self._cond:
+            self._followers += 1
+            self._unwatched_since = None
+
+    def detach(self) -> None:
+        with self._cond:
+            self._followers -= 1
+            if self._followers == 0:
+                self._unwatched_since = time.monotonic()
+
+    def cancelled(self) -> bool:
+        with self._cond:
+            return (self._unwatched_since is not None
+                    and time.monotonic() - self._unwatched_since > job_grace_seconds)
+
+    def events_from(self, index: int, timeout: float) -> tuple[list[Event], bool]:
+        """Events from `index` on, waiting up to `timeout` seconds for one; and whether the job has finished."""
+        with self._cond:
+            if len(self._events) <= index and not self._finished:
+                self._cond.wait(timeout)
+            return self._events[index:], self._finished
+
+    async def events_from_async(self, index: int, timeout: float) -> tuple[list[Event], bool]:
+        """As events_from, but waits on the running event loop rather than blocking a thread."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            if len(self._events) > index or self._finished:
+                return self._events[index:], self._finished
+            self._async_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._async_waiters.remove(waiter)
+        with self._cond:
+            return self._events[index:], self._finished
+
+
+class JobStore:
+    """Live and recently finished jobs, by ID and by the upload they transcribe; with their logs on disk."""
+
+    def __init__(self, directory: str, ttl_seconds: float):
+        self._directory = directory
+        self._ttl_seconds = ttl_seconds
+        self._jobs: dict[str, Job] = {}
+        self._by_file: dict[str, str] = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _log_path(self, job_id: str) -> str:
+        return os.path.join(self._directory, f"{job_id}.log")
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self._ttl_seconds:
+                del self._jobs[job_id]
+                if self._by_file.get(job.wav_file) == job_id:
+                    del self._by_file[job.wav_file]
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                job_id = entry.name.split('.', 1)[0]
+                try:
+                    if job_id not in self._jobs and time.time() - entry.stat().st_mtime > self._ttl_seconds:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                try:
+                    job = Job.load(job_id, self._log_path(job_id))
+                except FileNotFoundError:
+                    return None
+                self._jobs[job_id] = job
+            return job
+
+    def get_or_start(self, wav_file, make_events: Callable[[Job], Iterator[Optional[Event]]]) -> Job:
+        """
+        The job transcribing `wav_file`, starting one with the events from `make_events` if there is none.
+        Exceptions from `make_events` propagate, and no job is recorded.
+        """
+        with self._lock:
+            self._expire()
+            job_id = self._by_file.get(wav_file)
+            if job_id is not None:
+                return self._jobs[job_id]
+            job_id = uuid.uuid4().hex
+            job = Job(job_id, wav_file, self._log_path(job_id))
+            events = make_events(job)
+            self._jobs[job.id] = job
+            self._by_file[wav_file] = job.id
+        threading.Thread(target=job.run, args=(events,), daemon=True).start()
+        return job
+
+
+def pinned(wav_file, events: Iterator[Optional[Event]]) -> Iterator[Optional[Event]]:
+    """Keep `wav_file` safe from the janitor until `events` are exhausted."""
+    try:
+        yield from events
+    finally:
+        janitor.unpin(wav_file)
+
+
+def transcription_events(wav_file, chunked: bool, job: Job) -> Iterator[Optional[Event]]:
+    """Raises FileNotFoundError if there's no such upload, or QueueFullError if it would have to wait too long."""
+    if not os.path.exists(f"/tmp/whisper/{wav_file}.wav"):
+        raise FileNotFoundError(wav_file)
+
+    if chunked:
+        cache_key = TranscriptCache.key(wav_digest(wav_file), "chunked", str(segment_seconds),
+                                        str(segment_overlap_seconds))
+    else:
+        cache_key = TranscriptCache.key(wav_digest(wav_file))
+    transcript = transcript_cache.get(cache_key)
+    if transcript is not None:
+        return generate_cached_output(wav_file, transcript)
+
+    ticket = scheduler.submit()
+    generate = generate_chunked_output if chunked else generate_output
+    return generate(wav_file, ticket, cache_key, job.cancelled)
+
+
+def format_event(index: int, event: Event) -> str:
+    name, data = event
+    if name == "message":
+        return f"id: {index}\ndata: {data}\n\n"
+    return f"id: {index}\nevent: {name}\ndata: {data}\n\n"
+
+
+def follow_job(job: Job, index: int, client_disconnected: Callable[[], bool]):
+    while True:
+        events, finished = job.events_from(index, heartbeat_seconds)
+        for event in events:
+            yield format_event(index, event)
+            index += 1
+        if not events:
+            if finished:
+                return
+            if client_disconnected():
+                return
+            yield ': keepalive\n\n'
+
+
+def first_event_index(last_event_id: Optional[str]) -> int:
+    """The event to resume from, given the client's Last-Event-ID. Raises ValueError if it isn't one of ours."""
+    if last_event_id is None:
+        return 0
+    # -1 means "before the first event"; anything lower would index from the end.
+    if int(last_event_id) < -1:
+        raise ValueError(last_event_id)
+    return int(last_event_id) + 1
+
+
+def stream_job(job: Job) -> Response:
+    """Follow `job` as an event stream, resuming after the client's Last-Event-ID if it sent one."""
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id"))
+    try:
+        index = first_event_index(last_event_id)
+    except ValueError:
+        return Response(f"Last-Event-ID '{last_event_id}' is not an event ID", status=400)
+
+    client_disconnected = request.environ.get("waitress.client_disconnected", lambda: False)
+    job.attach()
+    response = Response(follow_job(job, index, client_disconnected), mimetype="text/event-stream")
+    response.call_on_close(job.detach)
+    return response
+
+
+def start_transcription(wav_file, chunked: bool) -> Job:
+    """The job for `wav_file`, started if need be. Raises FileNotFoundError or QueueFullError."""
+    def make_events(job: Job) -> Iterator[Optional[Event]]:
+        janitor.pin(wav_file)
+        try:
+            return pinned(wav_file, transcription_events(wav_file, chunked, job))
+        except BaseException:
+            janitor.unpin(wav_file)
+            raise
+
+    return jobs.get_or_start(wav_file, make_events)
+
+
+def stream_transcription(wav_file, chunked: bool = False) -> Response:
+    try:
+        job = start_transcription(wav_file, chunked)
+    except FileNotFoundError:
+        return Response(f"no uploaded file '{wav_file}'", status=404)
+    except QueueFullError:
+        return Response("transcription queue is full; try again later", status=503, headers={"Retry-After": "30"})
+    return stream_job(job)
 
 
 def obtain_youtube(url: AnyStr) -> str:
@@ -44,12 +934,124 @@ def obtain_youtube(url: AnyStr) -> str:
     raise Exception("DigitalOcean is rate limited to YouTube")
 
 
-def normalize(path: str, output: str):
+# ISO base media files (MP4, M4A, MOV, 3GP) often index their audio in a moov box at the end of the file,
+# which a decoder can only reach by seeking. Those are spooled to disk; everything else is piped.
+sniff_bytes = 12
+
+
+def needs_seekable_input(head: bytes) -> bool:
+    return head[4:8] == b"ftyp"
+
+
+def remove_quietly(path: str) -> None:
     try:
-        subprocess.run([normalize_binary, path, output], check=True)
-    except subprocess.CalledProcessError:
         os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def normalize_upload(output: str) -> Optional[Response]:
+    """
+    Stream the "file" part of the multipart request body straight into normalize.sh's stdin,
+    a chunk at a time, so the upload is never held in memory or written to disk unnormalized.
+    Formats that need a seekable input are spooled to `output`.upload instead, and normalized from there.
+    Returns an error response on failure.
+    """
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
+        return Response("expected a multipart/form-data upload", status=400)
+
+    started = time.monotonic()
+    decoder = MultipartDecoder(boundary.encode("ascii"))
+    spool_path = f"{output}.upload"
+    process = None
+    spool = None
+    # The file part's first bytes, held until we know whether it can be piped.
+    head = b""
+    found_file = False
+    in_file_part = False
+    received = 0
+
+    def start_sink() -> None:
+        nonlocal process, spool
+        if needs_seekable_input(head):
+            spool = open(spool_path, "wb")
+            spool.write(head)
+        else:
+            process = subprocess.Popen([normalize_binary, "/dev/stdin", output], stdin=subprocess.PIPE)
+            process.stdin.write(head)
+
+    def abandon(message: str) -> Response:
+        if process is not None:
+            process.kill()
+            process.wait()
+        if spool is not None:
+            spool.close()
+        remove_quietly(spool_path)
+        remove_quietly(f"{output}.wav")
+        return Response(message, status=400)
+
+    complete = False
+    try:
+        while True:
+            chunk = request.stream.read(upload_chunk_size)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, Data) and in_file_part:
+                    received += len(event.data)
+                    if process is not None:
+                        process.stdin.write(event.data)
+                    elif spool is not None:
+                        spool.write(event.data)
+                    else:
+                        head += event.data
+                        if len(head) >= sniff_bytes:
+                            start_sink()
+                elif not isinstance(event, Data):
+                    if in_file_part and process is None and spool is None:
+                        # A file shorter than we sniff; let the normalizer judge it.
+                        start_sink()
+                    in_file_part = isinstance(event, File) and event.name == "file" and not found_file
+                    found_file = found_file or in_file_part
+                event = decoder.next_event()
+            if isinstance(event, Epilogue):
+                complete = True
+                break
+            if not chunk:
+                break
+    except BrokenPipeError:
+        # The normalizer gave up on the input; its exit code tells us so below.
+        complete = True
+    except ValueError:
+        return abandon("malformed multipart body")
+
+    if not found_file:
+        return abandon('No "file" part in request')
+    if not complete:
+        # The body ended before the multipart epilogue: a truncated upload must not pass for a whole one.
+        return abandon("upload ended early")
+    if process is None and spool is None:
+        start_sink()
+
+    if spool is not None:
+        spool.close()
+        try:
+            succeeded = subprocess.run([normalize_binary, spool_path, output]).returncode == 0
+        finally:
+            remove_quietly(spool_path)
+    else:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        succeeded = process.wait() == 0
+    if not succeeded:
+        remove_quietly(f"{output}.wav")
         return Response("failed to normalize", status=500)
+    metric_upload_bytes.observe(received)
+    metric_normalize_seconds.observe(time.monotonic() - started)
+    return None
 
 
 @app.route('/transcribe-youtube')
@@ -61,7 +1063,7 @@ def transcribe_youtube():
     if youtube_regex.match(url) is None:
         return Response(f"url '{url}' did not appear to be a YouTube video", status=400)
     wav_file = obtain_youtube(url)
-    return Response(generate_output(wav_file), mimetype="text/event-stream")
+    return stream_transcription(wav_file)
 
 
 @app.route('/transcribe-file')
@@ -72,7 +1074,18 @@ def transcribe_file():
         return Response("must have a file as obtained from /upload, in the format ?file=...", status=400)
     if acceptable_regex.match(file) is None:
         return Response(f"filename '{file}' did not match acceptable regex", status=400)
-    return Response(generate_output(file), mimetype="text/event-stream")
+    return stream_transcription(file, chunked=request.args.get('chunked') in ('1', 'true'))
+
+
+@app.route('/job-events')
+def job_events():
+    job_id = request.args.get('id')
+    if job_id is None or acceptable_regex.match(job_id) is None:
+        return Response(f"job ID '{job_id}' did not match acceptable regex", status=400)
+    job = jobs.get(job_id)
+    if job is None:
+        return Response(f"no job '{job_id}'", status=404)
+    return stream_job(job)
 
 
 @app.route('/transcribe-ui')
@@ -82,31 +1095,32 @@ def index():
 
 @app.route('/upload', methods=["POST"])
 def upload():
-    if 'file' not in request.files:
-        return 'No "file" part in request', 400
-    file = request.files['file']
-
+    """
+    Normalize the uploaded file and reply with its name for /transcribe-file.
+    With ?transcribe=1, reply instead with the transcription event stream for it.
+    """
     try:
         os.mkdir("/tmp/whisper")
     except FileExistsError:
         pass
 
-    # Create temp file for this upload
-    handle, temp_file = tempfile.mkstemp(text=False)
-    try:
-        os.close(handle)
-        file.save(temp_file)
-        # get filename from absolute path
-        temp_file_frag = os.path.basename(temp_file)
+    # The upload's size is the best estimate we have of the normalized WAV's.
+    if not janitor.admit(request.content_length or 0):
+        return Response("not enough space for another upload; try again later", status=507)
 
-        normalize(temp_file, f"/tmp/whisper/{temp_file_frag}")
+    file_frag = uuid.uuid4().hex
+    janitor.pin(file_frag)
+    try:
+        error = normalize_upload(f"/tmp/whisper/{file_frag}")
+        if error is not None:
+            return error
+        upload_digests[file_frag] = file_digest(f"/tmp/whisper/{file_frag}.wav")
     finally:
-        try:
-            os.remove(temp_file)
-        finally:
-            pass
+        janitor.unpin(file_frag)
 
-    return Response(temp_file_frag, mimetype="text/plain")
+    if request.args.get('transcribe') in ('1', 'true'):
+        return stream_transcription(file_frag, chunked=request.args.get('chunked') in ('1', 'true'))
+    return Response(file_frag, mimetype="text/plain")
 
 
 @app.route('/download')
@@ -116,14 +1130,159 @@ def download():
     except KeyError:
         return Response("must have a file parameter", status=400)
 
-    if acceptable_regex.match(file) is None:
+    if file is None or acceptable_regex.match(file) is None:
         return Response(f"file '{file}' did not match acceptable regex, bad format", status=400)
 
-    return Response(open(f"/tmp/whisper/{file}.wav", 'rb').read(), mimetype="audio/wav")
+    # send_file hands the open file to the server's wsgi.file_wrapper rather than reading it into memory,
+    # and with conditional=True answers Range requests with 206 and sets ETag/Last-Modified.
+    try:
+        return send_file(f"/tmp/whisper/{file}.wav", mimetype="audio/wav", conditional=True, etag=True,
+                         max_age=0)
+    except FileNotFoundError:
+        return Response(f"no uploaded file '{file}'", status=404)
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    return transcript_cache.stats()
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.monotonic()
+
+
+@app.after_request
+def observe_request(response: Response) -> Response:
+    started = g.get("request_started")
+    if started is not None:
+        metric_request_seconds.labels(request.endpoint or "unmatched").observe(time.monotonic() - started)
+    return response
+
+
+async def asgi_text(send, status: int, text: str, headers: Optional[list[tuple[bytes, bytes]]] = None) -> None:
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8"), *(headers or [])]})
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+
+
+async def until_disconnected(receive, stream: Awaitable[None]) -> None:
+    """Run `stream`, cancelling it if the client disconnects first."""
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = {asyncio.ensure_future(stream), asyncio.ensure_future(disconnected())}
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def asgi_follow_job(job: Job, index: int, receive, send) -> None:
+    async def stream():
+        nonlocal index
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+        while True:
+            events, finished = await job.events_from_async(index, heartbeat_seconds)
+            if events:
+                body = "".join(format_event(index + i, event) for i, event in enumerate(events))
+                index += len(events)
+            elif finished:
+                break
+            else:
+                body = ": keepalive\n\n"
+            await send({"type": "http.response.body", "body": body.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    job.attach()
+    try:
+        await until_disconnected(receive, stream())
+    finally:
+        job.detach()
+
+
+async def asgi_transcription(scope, receive, send) -> None:
+    """/transcribe-file and /job-events, served on the event loop so that an idle stream costs no thread."""
+    started = time.monotonic()
+    query = parse_qs(scope["query_string"].decode("latin1"))
+    headers = {name.decode("latin1").lower(): value.decode("latin1") for name, value in scope["headers"]}
+    loop = asyncio.get_running_loop()
+
+    if scope["path"] == "/transcribe-file":
+        endpoint = "transcribe_file"
+        file = query.get("file", [None])[0]
+        if file is None or acceptable_regex.match(file) is None:
+            await asgi_text(send, 400, f"filename '{file}' did not match acceptable regex")
+            return
+        chunked = query.get("chunked", [None])[0] in ("1", "true")
+        try:
+            # Hashing the upload and reading the cache are blocking, so they go to a thread.
+            job = await loop.run_in_executor(None, start_transcription, file, chunked)
+        except FileNotFoundError:
+            await asgi_text(send, 404, f"no uploaded file '{file}'")
+            return
+        except QueueFullError:
+            await asgi_text(send, 503, "transcription queue is full; try again later", [(b"retry-after", b"30")])
+            return
+    else:
+        endpoint = "job_events"
+        job_id = query.get("id", [None])[0]
+        if job_id is None or acceptable_regex.match(job_id) is None:
+            await asgi_text(send, 400, f"job ID '{job_id}' did not match acceptable regex")
+            return
+        job = await loop.run_in_executor(None, jobs.get, job_id)
+        if job is None:
+            await asgi_text(send, 404, f"no job '{job_id}'")
+            return
+
+    last_event_id = headers.get("last-event-id", query.get("last_event_id", [None])[0])
+    try:
+        index = first_event_index(last_event_id)
+    except ValueError:
+        await asgi_text(send, 400, f"Last-Event-ID '{last_event_id}' is not an event ID")
+        return
+
+    metric_request_seconds.labels(endpoint).observe(time.monotonic() - started)
+    await asgi_follow_job(job, index, receive, send)
+
+
+def make_asgi_app(threads: int):
+    """
+    The Flask app as ASGI, with the event-stream routes served natively on the event loop,
+    and everything else run on a pool of `threads` threads.
+    """
+    from a2wsgi import WSGIMiddleware
+
+    wsgi_app = WSGIMiddleware(app, workers=threads)
+
+    async def asgi_app(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in ("/transcribe-file", "/job-events"):
+            await asgi_transcription(scope, receive, send)
+        else:
+            await wsgi_app(scope, receive, send)
+
+    return asgi_app
+
 
+def run(port: int, threads: int, server: str = "waitress"):
+    if server == "asgi":
+        import uvicorn
 
-def run(port: int):
-    waitress.serve(app, host="0.0.0.0", port=port)
+        uvicorn.run(make_asgi_app(threads), host="0.0.0.0", port=port, lifespan="off")
+    else:
+        # A non-zero lookahead makes waitress keep reading the socket during a response,
+        # which is what lets it report client disconnects to long-running streams.
+        waitress.serve(app, host="0.0.0.0", port=port, threads=threads, channel_request_lookahead=1)
 
 
 if __name__ == "__main__":
@@ -131,4 +1290,23 @@ if __name__ == "__main__":
     whisper = os.environ["WHISPER_CLIENT"]
     index_page_path = os.environ["INDEX_PAGE_PATH"]
     ytdlp = os.environ["YT_DLP"]
-    run(int(os.environ["WHISPER_PORT"]))
+    workers = int(os.environ.get("WHISPER_WORKERS") or os.cpu_count() or 1)
+    max_queued = int(os.environ.get("WHISPER_MAX_QUEUE", "8"))
+    scheduler = JobScheduler(workers=workers, max_queued=max_queued)
+    transcript_cache = TranscriptCache(
+        os.environ.get("WHISPER_CACHE_DIR", "/var/cache/whisper"),
+        max_bytes=int(os.environ.get("WHISPER_CACHE_BYTES", str(256 * 1024 * 1024))))
+    janitor = TempJanitor(
+        "/tmp/whisper",
+        ttl_seconds=float(os.environ.get("WHISPER_TMP_TTL_SECONDS", str(6 * 60 * 60))),
+        quota_bytes=int(os.environ.get("WHISPER_TMP_QUOTA_BYTES", str(1024 * 1024 * 1024))))
+    janitor.start()
+    jobs = JobStore(
+        os.environ.get("WHISPER_JOB_DIR", "/var/lib/whisper/jobs"),
+        ttl_seconds=float(os.environ.get("WHISPER_JOB_TTL_SECONDS", str(6 * 60 * 60))))
+    REGISTRY.register(ServerCollector())
+    # Under waitress, every client following a transcription holds a thread for its event stream;
+    # leave a few spare so uploads and the UI stay responsive. The asgi server needs no such slack,
+    # because it serves event streams on its event loop.
+    run(int(os.environ["WHISPER_PORT"]), threads=workers + max_queued + 4,
+        server=os.environ.get("WHISPER_SERVER", "waitress"))
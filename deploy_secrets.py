@@ -1,16 +1,28 @@
 #!/usr/bin/env python3
 """
-Encrypt and deploy secrets to a remote NixOS host.
+Encrypt and deploy secrets to one or more remote NixOS hosts, concurrently.
 
 Usage:
     ./deploy-secrets.py secrets.json patrick@nas
     ./deploy-secrets.py secrets.json root@digitalocean-ip --age-key-file ~/.age/do-key.txt
+    ./deploy-secrets.py secrets.json patrick@nas root@digitalocean-ip
+    ./deploy-secrets.py secrets.json --inventory hosts.txt --jobs 8
+
+Each host gets the secrets encrypted to its own age key: --age-key-file for hosts named on the command line,
+and for inventory lines that name only a host; an inventory line "host key-file" gives that host its own key.
 """
 
 import argparse
+import hashlib
+import shlex
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Optional
 
 
 def get_age_recipients(key_file: Path) -> str:
@@ -36,74 +48,213 @@ def encrypt_file(plaintext_path: Path, recipient: str) -> bytes:
     return result.stdout
 
 
+class RemoteHost:
+    """An SSH destination, counting the sessions opened to it: each costs a TCP and key-exchange handshake."""
+
+    def __init__(self, destination: str, timeout: float):
+        self.destination = destination
+        self.timeout = timeout
+        self.round_trips = 0
+
+    def run(self, command: str, input: Optional[bytes] = None) -> subprocess.CompletedProcess:
+        """Run a command on the host, giving up after `timeout` seconds so one slow host can't hang the run."""
+        self.round_trips += 1
+        try:
+            return subprocess.run(
+                ["ssh", self.destination, command],
+                input=input,
+                capture_output=True,
+                timeout=self.timeout,
+            )
+        except subprocess.TimeoutExpired:
+            raise RuntimeError(f"Timed out after {self.timeout:g}s")
+
+
+def digest_path(remote_secrets_path: str) -> str:
+    """Where a host records the `secrets_digest` of what it was last sent."""
+    return f"{remote_secrets_path}.sha256"
+
+
+def secrets_digest(plaintext: bytes, recipient: str) -> str:
+    """
+    The SHA-256 of the recipient and the plaintext: a host holding the same plaintext encrypted to a different
+    key still needs the upload.
+    """
+    return hashlib.sha256(recipient.encode() + b"\n" + plaintext).hexdigest()
+
+
+def probe_script(remote_secrets_path: str, remote_key_path: str) -> str:
+    """A shell script printing the host's recorded secrets digest, and whether it has an age key."""
+    return "\n".join([
+        f"cat {shlex.quote(digest_path(remote_secrets_path))} 2>/dev/null || true",
+        f"if [ -f {shlex.quote(remote_key_path)} ]; then echo key-present; fi",
+    ])
+
+
+def deploy_script(
+    remote_secrets_path: str,
+    secrets_size: int,
+    secrets_digest: str,
+    remote_key_path: str,
+    key_size: Optional[int],
+) -> str:
+    """
+    A shell script that reads the age key (if `key_size` is given) and then the encrypted secrets from stdin,
+    and installs each with mode 600 by renaming a temporary file over it, so no reader sees a partial file.
+    The key is only installed if the host doesn't already have one. The digest is recorded last, so that an
+    interrupted deploy is retried.
+    """
+    secrets = shlex.quote(remote_secrets_path)
+    digest = shlex.quote(digest_path(remote_secrets_path))
+    lines = ["set -e", "umask 077"]
+    if key_size is not None:
+        key = shlex.quote(remote_key_path)
+        lines += [
+            f"if [ -f {key} ]; then",
+            f"  head -c {key_size} > /dev/null",
+            "  echo key-present",
+            "else",
+            f"  head -c {key_size} > {key}.tmp.$$",
+            f"  chmod 600 {key}.tmp.$$",
+            f"  mv -f {key}.tmp.$$ {key}",
+            "  echo key-deployed",
+            "fi",
+        ]
+    lines += [
+        f"head -c {secrets_size} > {secrets}.tmp.$$",
+        f"chmod 600 {secrets}.tmp.$$",
+        f"mv -f {secrets}.tmp.$$ {secrets}",
+        f"echo {secrets_digest} > {digest}.tmp.$$",
+        f"mv -f {digest}.tmp.$$ {digest}",
+        "echo secrets-deployed",
+    ]
+    return "\n".join(lines)
+
+
+def sudo_sh(script: str, use_sudo: bool) -> str:
+    command = f"sh -c {shlex.quote(script)}"
+    return f"sudo {command}" if use_sudo else command
+
+
+def probe_remote(
+    remote: RemoteHost,
+    remote_path: str,
+    remote_key_path: str,
+    use_sudo: bool,
+) -> tuple[Optional[str], bool]:
+    """The digest of the secrets the host last received (if recorded), and whether it has an age key."""
+    result = remote.run(sudo_sh(probe_script(remote_path, remote_key_path), use_sudo))
+    if result.returncode != 0:
+        raise RuntimeError(f"Probe failed: {result.stderr.decode().strip()}")
+    report = result.stdout.decode().split()
+    digests = [word for word in report if len(word) == 64]
+    return (digests[0] if digests else None), "key-present" in report
+
+
 def deploy_to_remote(
     encrypted_data: bytes,
-    remote_host: str,
+    secrets_digest: str,
+    remote: RemoteHost,
     remote_path: str,
+    key_data: Optional[bytes],
+    remote_key_path: str,
     use_sudo: bool,
 ) -> None:
-    """Deploy encrypted secrets to remote host."""
-    sudo = "sudo " if use_sudo else ""
-
-    # Write encrypted data to remote
-    result = subprocess.run(
-        ["ssh", remote_host, f"{sudo}tee {remote_path} > /dev/null"],
-        input=encrypted_data,
-        capture_output=True,
-    )
+    """Deploy the age key (if given, and not already present) and the encrypted secrets in one SSH session."""
+    key_size = None if key_data is None else len(key_data)
+    script = deploy_script(remote_path, len(encrypted_data), secrets_digest, remote_key_path, key_size)
+    result = remote.run(sudo_sh(script, use_sudo), input=(key_data or b"") + encrypted_data)
     if result.returncode != 0:
-        raise RuntimeError(f"Failed to write to remote: {result.stderr.decode()}")
+        raise RuntimeError(f"Deploy script failed: {result.stderr.decode().strip()}")
 
-    # Set permissions
-    result = subprocess.run(
-        ["ssh", remote_host, f"{sudo}chmod 600 {remote_path}"],
-        capture_output=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to set permissions: {result.stderr.decode()}")
+    report = result.stdout.decode().split()
+    if "key-present" in report:
+        print(f"[{remote.destination}] Age key already exists at {remote_key_path}, skipping")
+    elif "key-deployed" in report:
+        print(f"[{remote.destination}] Deployed age key to {remote_key_path}")
+    if "secrets-deployed" not in report:
+        raise RuntimeError(f"Deploy script did not finish: {result.stdout.decode()}")
+
+
+@dataclass
+class HostResult:
+    host: str
+    seconds: float
+    round_trips: int
+    error: Optional[str] = None
+    unchanged: bool = False
 
 
-def deploy_age_key(
-    local_key_file: Path,
+def deploy_host(
     remote_host: str,
-    remote_path: str,
-    use_sudo: bool,
-) -> None:
-    """Deploy the age private key to the remote host (if not already present)."""
-    sudo = "sudo " if use_sudo else ""
+    key_file: Path,
+    secrets_digest: str,
+    encrypted: Callable[[Path], bytes],
+    args: argparse.Namespace,
+) -> HostResult:
+    """
+    Deploy the age key `key_file` (unless skipped) and the secrets encrypted to it to one host, never raising.
+    Unless forced, the host is asked first for the digest of what it last received, and left alone if that
+    matches.
+    """
+    start = time.monotonic()
+    remote = RemoteHost(remote_host, args.timeout)
+    use_sudo = not args.no_sudo
+    try:
+        key_present = False
+        if not args.force:
+            remote_digest, key_present = probe_remote(remote, args.remote_secrets_path, args.remote_key_path, use_sudo)
+            if remote_digest == secrets_digest and (key_present or args.skip_key_deploy):
+                print(f"[{remote_host}] Secrets unchanged, skipping upload")
+                return HostResult(remote_host, time.monotonic() - start, remote.round_trips, unchanged=True)
 
-    # Check if key already exists
-    result = subprocess.run(
-        ["ssh", remote_host, f"test -f {remote_path}"],
-        capture_output=True,
-    )
-    if result.returncode == 0:
-        print(f"Age key already exists at {remote_path}, skipping")
-        return
+        deploy_to_remote(
+            encrypted(key_file),
+            secrets_digest,
+            remote,
+            args.remote_secrets_path,
+            key_data=None if args.skip_key_deploy or key_present else key_file.read_bytes(),
+            remote_key_path=args.remote_key_path,
+            use_sudo=use_sudo,
+        )
+        print(f"[{remote_host}] Deployed encrypted secrets to {args.remote_secrets_path}")
+        return HostResult(remote_host, time.monotonic() - start, remote.round_trips)
+    except RuntimeError as e:
+        print(f"[{remote_host}] Error: {e}", file=sys.stderr)
+        return HostResult(remote_host, time.monotonic() - start, remote.round_trips, str(e))
 
-    key_data = local_key_file.read_bytes()
 
-    result = subprocess.run(
-        ["ssh", remote_host, f"{sudo}tee {remote_path} > /dev/null"],
-        input=key_data,
-        capture_output=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to write key: {result.stderr.decode()}")
+def read_inventory(path: Path, default_key_file: Path) -> list[tuple[str, Path]]:
+    """
+    One SSH destination per line, optionally followed by the path of that host's age key, which otherwise
+    defaults to `default_key_file`. Blank lines and #-comments are ignored.
+    """
+    hosts = []
+    for number, line in enumerate(path.read_text().splitlines(), 1):
+        fields = line.split("#", 1)[0].split()
+        if len(fields) > 2:
+            raise RuntimeError(f"{path}:{number}: expected a host and at most one key file")
+        if fields:
+            key_file = Path(fields[1]).expanduser() if len(fields) == 2 else default_key_file
+            hosts.append((fields[0], key_file))
+    return hosts
 
-    result = subprocess.run(
-        ["ssh", remote_host, f"{sudo}chmod 600 {remote_path}"],
-        capture_output=True,
-    )
-    if result.returncode != 0:
-        raise RuntimeError(f"Failed to set key permissions: {result.stderr.decode()}")
 
-    print(f"Deployed age key to {remote_path}")
+def print_summary(results: list[HostResult]) -> None:
+    width = max(len(result.host) for result in results)
+    print("\nSummary:")
+    for result in results:
+        if result.error is not None:
+            status = f"FAILED: {result.error.strip()}"
+        else:
+            status = "unchanged" if result.unchanged else "deployed"
+        trips = f"{result.round_trips} SSH round trip{'' if result.round_trips == 1 else 's'}"
+        print(f"  {result.host:<{width}}  {result.seconds:6.1f}s  {trips}  {status}")
 
 
 def main() -> int:
     parser = argparse.ArgumentParser(
-        description="Encrypt and deploy secrets to a remote NixOS host"
+        description="Encrypt and deploy secrets to remote NixOS hosts"
     )
     parser.add_argument(
         "json_file",
@@ -111,14 +262,32 @@ def main() -> int:
         help="Path to plaintext secrets JSON file",
     )
     parser.add_argument(
-        "remote_host",
-        help="SSH destination (e.g., patrick@192.168.1.100)",
+        "remote_hosts",
+        nargs="*",
+        help="SSH destinations (e.g., patrick@192.168.1.100)",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=Path,
+        help="File of further SSH destinations, one per line, each optionally followed by its age key file",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Hosts to deploy to at once (default: 4)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        help="Seconds to allow each remote command before giving up on a host (default: 120)",
     )
     parser.add_argument(
         "--age-key-file",
         type=Path,
         default=Path.home() / ".age" / "secrets-key.txt",
-        help="Path to local age private key (default: ~/.age/secrets-key.txt)",
+        help="Path to local age private key, for hosts not given their own (default: ~/.age/secrets-key.txt)",
     )
     parser.add_argument(
         "--remote-secrets-path",
@@ -140,6 +309,11 @@ def main() -> int:
         action="store_true",
         help="Don't deploy the age key (assume it's already there)",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Upload even to hosts whose secrets digest already matches",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -151,47 +325,78 @@ def main() -> int:
         print(f"Error: {args.json_file} not found", file=sys.stderr)
         return 1
 
-    if not args.age_key_file.exists():
-        print(f"Error: {args.age_key_file} not found", file=sys.stderr)
-        print("Generate one with: age-keygen -o ~/.age/secrets-key.txt", file=sys.stderr)
+    hosts = [(host, args.age_key_file) for host in args.remote_hosts]
+    try:
+        if args.inventory is not None:
+            if not args.inventory.exists():
+                print(f"Error: {args.inventory} not found", file=sys.stderr)
+                return 1
+            hosts += read_inventory(args.inventory, args.age_key_file)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
         return 1
+    # Preserve order, but don't deploy to the same host twice at once.
+    key_files: dict[str, Path] = {}
+    for host, key_file in hosts:
+        if key_files.setdefault(host, key_file) != key_file:
+            print(f"Error: {host} is given two age keys, {key_files[host]} and {key_file}", file=sys.stderr)
+            return 1
+    if not key_files:
+        print("Error: give at least one remote host, or --inventory", file=sys.stderr)
+        return 1
+
+    for key_file in dict.fromkeys(key_files.values()):
+        if not key_file.exists():
+            print(f"Error: {key_file} not found", file=sys.stderr)
+            print(f"Generate one with: age-keygen -o {key_file}", file=sys.stderr)
+            return 1
 
     try:
-        recipient = get_age_recipients(args.age_key_file)
-        print(f"Using age recipient: {recipient}")
+        recipients = {key_file: get_age_recipients(key_file) for key_file in dict.fromkeys(key_files.values())}
+        for key_file, recipient in recipients.items():
+            print(f"Using age recipient: {recipient} ({key_file})")
 
         if args.dry_run:
             print(f"Would encrypt {args.json_file}")
-            print(f"Would deploy encrypted secrets to {args.remote_host}:{args.remote_secrets_path}")
-            if not args.skip_key_deploy:
-                print(f"Would deploy age key to {args.remote_host}:{args.remote_key_path}")
+            for host, key_file in key_files.items():
+                print(f"Would deploy encrypted secrets to {host}:{args.remote_secrets_path}")
+                if not args.skip_key_deploy:
+                    print(f"Would deploy age key {key_file} to {host}:{args.remote_key_path}")
             return 0
 
-        encrypted = encrypt_file(args.json_file, recipient)
-        print(f"Encrypted {args.json_file} ({len(encrypted)} bytes)")
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
 
-        if not args.skip_key_deploy:
-            deploy_age_key(
-                args.age_key_file,
-                args.remote_host,
-                args.remote_key_path,
-                use_sudo=not args.no_sudo,
-            )
+    plaintext = args.json_file.read_bytes()
+    digests = {key_file: secrets_digest(plaintext, recipient) for key_file, recipient in recipients.items()}
+    # Hosts sharing an age key share a ciphertext, so the secrets are encrypted at most once per key, and only
+    # if a host holding that key needs them.
+    encrypt_lock = threading.Lock()
+    ciphertexts: dict[str, bytes] = {}
 
-        deploy_to_remote(
-            encrypted,
-            args.remote_host,
-            args.remote_secrets_path,
-            use_sudo=not args.no_sudo,
-        )
-        print(f"Deployed encrypted secrets to {args.remote_host}:{args.remote_secrets_path}")
+    def encrypted(key_file: Path) -> bytes:
+        recipient = recipients[key_file]
+        with encrypt_lock:
+            if recipient not in ciphertexts:
+                ciphertexts[recipient] = encrypt_file(args.json_file, recipient)
+                print(f"Encrypted {args.json_file} for {recipient} ({len(ciphertexts[recipient])} bytes)")
+            return ciphertexts[recipient]
 
-        print("\nSecrets deployed. Run 'systemctl restart json-secrets' on the remote to apply.")
-        return 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        results = list(pool.map(
+            lambda host: deploy_host(host, key_files[host], digests[key_files[host]], encrypted, args), key_files))
 
-    except RuntimeError as e:
-        print(f"Error: {e}", file=sys.stderr)
+    print_summary(results)
+    if any(result.error is not None for result in results):
         return 1
+    changed = [result.host for result in results if not result.unchanged]
+    if changed:
+        print(f"\nSecrets deployed. Run 'systemctl restart json-secrets' on {', '.join(changed)} to apply,")
+        print("unless they run json-secrets-watch, which applies them as they arrive.")
+    else:
+        print("\nEvery host already has these secrets.")
+    return 0
 
 
 if __name__ == "__main__":